@@ -0,0 +1,93 @@
+"""Compare the packing algorithms and sort orders of the auto-packed mod textures
+
+    python -m benchmarks.atlas_packing
+    python -m benchmarks.atlas_packing --mods path/to/mods
+
+Packs sets of generated texture sizes, or the textures of the mods in a folder, with every
+combination of MODLOADER_PACK_ALGORITHM and MODLOADER_PACK_SORT, and reports the number of
+2048 x 2048 pages used and how long the packing took.
+"""
+
+import argparse
+import os
+import random
+import time
+
+from loader.assets import pngcodec
+from loader.assets import texturemanager
+
+# (name, number of textures, smallest side, largest side)
+GENERATED = (
+    ("icons", 500, 16, 128),
+    ("sprites", 150, 32, 512),
+    ("large", 40, 256, 1024),
+)
+
+
+class _Texture:
+    """Just what TextureManager.pack needs from a RegisteredTexture"""
+
+    def __init__(self, name, width, height):
+        self.Name = name
+        self.FileSizeX = width
+        self.FileSizeY = height
+
+    def getName(self):
+        return self.Name
+
+    def __str__(self):
+        return "{} ({}, {})".format(self.Name, self.FileSizeX, self.FileSizeY)
+
+
+def _generated(count, smallest, largest, seed=0):
+    rng = random.Random(seed)
+    return [_Texture(str(i), rng.randint(smallest, largest), rng.randint(smallest, largest)) for i in range(count)]
+
+
+def _mods(modsPath):
+    textures = []
+    for mod in sorted(os.listdir(modsPath)):
+        texturesPath = os.path.join(modsPath, mod, "textures")
+        if not os.path.isdir(texturesPath):
+            continue
+        for filename in sorted(os.listdir(texturesPath)):
+            if filename.endswith(".png"):
+                (w, h) = pngcodec.size(os.path.join(texturesPath, filename))
+                textures.append(_Texture("{}/{}".format(mod, filename), w, h))
+    return textures
+
+
+def run(textures, algorithms, sorts):
+    """Yield (algorithm, sort, pages, seconds) as each packing completes"""
+    for algorithm in algorithms:
+        for sort in sorts:
+            manager = texturemanager.TextureManager(algorithm, sort)
+            manager.REGISTERED_MOD_TEXTURES = textures
+            start = time.perf_counter()
+            manager.pack()
+            yield algorithm, sort, manager.getBinCount(), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mods", help="pack the textures of the mods in this folder instead of generated ones")
+    parser.add_argument("--algorithm", action="append", help="algorithm to compare, can be repeated (default: all)")
+    parser.add_argument("--sort", action="append", help="sort order to compare, can be repeated (default: all)")
+    args = parser.parse_args()
+
+    if args.mods:
+        sets = [(args.mods, _mods(args.mods))]
+    else:
+        sets = [(name, _generated(count, smallest, largest)) for name, count, smallest, largest in GENERATED]
+
+    for name, textures in sets:
+        area = sum(t.FileSizeX * t.FileSizeY for t in textures)
+        print()
+        print(f"{name}: {len(textures)} textures, {area / 2048**2:.2f} pages worth of pixels")
+        print(f"{'algorithm':<18} {'sort':<11} {'pages':>5} {'pack s':>7}")
+        for algorithm, sort, pages, elapsed in run(textures, args.algorithm or list(texturemanager.PACK_ALGORITHMS), args.sort or list(texturemanager.PACK_SORTS)):
+            print(f"{algorithm:<18} {sort:<11} {pages:>5} {elapsed:>7.2f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Compare the output profiles on a real spacehaven.jar
+
+    python -m benchmarks.output_profiles path/to/spacehaven.jar
+
+Every patchable file is treated as modded, which is the worst case for a build: all the
+cim pages are compressed again and all the XML files are deflated into the output jar.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from loader.assets.explode import Texture
+from loader.assets.library import OUTPUT_PROFILES, PATCHABLE_CIM_FILES, PATCHABLE_XML_FILES, VanillaLibrary, patch
+
+
+def run(jarPath, profiles, repeat):
+    with VanillaLibrary(jarPath) as vanilla:
+        names = set(vanilla.namelist())
+        xml_files = {filename: vanilla.read(filename) for filename in PATCHABLE_XML_FILES}
+        cim_files = {filename: vanilla.read(filename) for filename in PATCHABLE_CIM_FILES if filename in names}
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        resultPath = os.path.join(tmp, "spacehaven.jar")
+        for name in profiles:
+            profile = OUTPUT_PROFILES[name]
+            cim_time = jar_time = float("inf")
+            for _ in range(repeat):
+                modded = dict(xml_files)
+                elapsed = 0.0
+                for filename, data in cim_files.items():
+                    texture = Texture(filename, data=data)
+                    start = time.perf_counter()
+                    modded[filename] = texture.export_cim_bytes(filename, profile["cim_level"])
+                    elapsed += time.perf_counter() - start
+                cim_time = min(cim_time, elapsed)
+
+                start = time.perf_counter()
+                patch(jarPath, resultPath, modded, profile=profile)
+                jar_time = min(jar_time, time.perf_counter() - start)
+
+            cim_size = sum(len(modded[filename]) for filename in cim_files)
+            results.append((name, cim_time, cim_size, jar_time, os.path.getsize(resultPath)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("jar", help="path to a vanilla spacehaven.jar")
+    parser.add_argument("--profile", action="append", choices=list(OUTPUT_PROFILES), help="profile to run, can be repeated (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per profile, the best one is reported")
+    args = parser.parse_args()
+
+    results = run(args.jar, args.profile or list(OUTPUT_PROFILES), args.repeat)
+
+    print()
+    print(f"{'profile':<10} {'cim s':>8} {'cim MB':>8} {'jar s':>8} {'jar MB':>8}")
+    for name, cim_time, cim_size, jar_time, jar_size in results:
+        print(f"{name:<10} {cim_time:>8.2f} {cim_size / 2**20:>8.1f} {jar_time:>8.2f} {jar_size / 2**20:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""Time the phases of a mod build on a synthetic game and mods
+
+    python -m benchmarks.pipeline --output results.json
+    python -m benchmarks.pipeline --compare results.json
+
+Generates a spacehaven.jar and a set of mods (see benchmarks.synthetic) in a temporary
+folder, then reports the wall time and peak memory of every phase of a build:
+the vanilla library cache, merge.mods (including doMerges and doPatches), library.patch
+and a complete loader.load.load: cold, with the caches on disk, and relaunched in the same
+process with the core library still parsed in memory.
+"""
+
+import argparse
+import contextlib
+import ctypes
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks import synthetic
+
+# sampling period of the resident memory, in seconds
+RSS_INTERVAL = 0.005
+
+
+def _rss():
+    """Resident memory of this process in bytes, None if it can't be measured here"""
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, AttributeError, ValueError):
+        pass
+
+    if sys.platform == "win32":
+        return _windows_rss()
+
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+class _PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+    _fields_ = [
+        ("cb", ctypes.c_uint32),
+        ("PageFaultCount", ctypes.c_uint32),
+        ("PeakWorkingSetSize", ctypes.c_size_t),
+        ("WorkingSetSize", ctypes.c_size_t),
+        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+        ("PagefileUsage", ctypes.c_size_t),
+        ("PeakPagefileUsage", ctypes.c_size_t),
+    ]
+
+
+def _windows_rss():
+    """Working set of this process, the Windows counterpart of the resident memory"""
+
+    kernel32 = ctypes.windll.kernel32
+    kernel32.GetCurrentProcess.restype = ctypes.c_void_p
+    kernel32.K32GetProcessMemoryInfo.argtypes = [ctypes.c_void_p, ctypes.POINTER(_PROCESS_MEMORY_COUNTERS), ctypes.c_uint32]
+    counters = _PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    if not kernel32.K32GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+        return None
+    return counters.WorkingSetSize
+
+
+class PeakRSS:
+    """Sample the resident memory in a thread for the duration of a `with` block"""
+
+    def __enter__(self):
+        self.peak = _rss()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._done.set()
+        self._thread.join()
+
+    def _sample(self):
+        while self.peak is not None and not self._done.wait(RSS_INTERVAL):
+            self.peak = max(self.peak, _rss())
+
+
+class Phases:
+    """Wall time and peak memory of named phases, keeping the best of repeated runs"""
+
+    def __init__(self):
+        self.results = {}
+        self.calls = {}
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        with PeakRSS() as rss:
+            start = time.perf_counter()
+            yield
+            elapsed = time.perf_counter() - start
+        self.record(name, elapsed, rss.peak)
+
+    def record(self, name, elapsed, peak=None):
+        result = self.results.setdefault(name, {"wall_s": float("inf"), "peak_rss_mb": None})
+        result["wall_s"] = min(result["wall_s"], elapsed)
+        if peak is not None:
+            result["peak_rss_mb"] = max(result["peak_rss_mb"] or 0, peak / 2**20)
+
+    def wrap(self, module, function):
+        """Accumulate the time spent in `module.function` for each call of a measured phase"""
+
+        original = getattr(module, function)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.calls[function] = self.calls.get(function, 0.0) + time.perf_counter() - start
+
+        setattr(module, function, timed)
+
+
+def _locate_mods(jarPath, modsPath):
+    import ui.database
+    import ui.gameinfo
+
+    gameInfo = ui.gameinfo.GameInfo(jarPath)
+    database = ui.database.ModDatabase([modsPath], gameInfo)
+    database.locateMods()
+    return gameInfo, database.getActiveMods()
+
+
+def _reset_game(work, jarPath):
+    game = os.path.join(work, "game")
+    shutil.rmtree(game, ignore_errors=True)
+    os.makedirs(game)
+    shutil.copy2(jarPath, os.path.join(game, "spacehaven.jar"))
+    with open(os.path.join(game, "config.json"), "w") as f:
+        json.dump({"classPath": ["spacehaven.jar"], "vmArgs": []}, f)
+    return os.path.join(game, "spacehaven.jar")
+
+
+def _release_warm_trees():
+    """Drop the core library kept in memory between loads, once its background parsing is done"""
+
+    import loader.assets.warm
+
+    loader.assets.warm.TREES.wait()
+    loader.assets.warm.TREES.release("benchmark")
+
+
+def run(work, sizes, mod_count, sprites, repeat):
+    import loader.assets.cache
+    import loader.assets.library
+    import loader.assets.merge
+    import loader.assets.warm
+    import loader.load
+
+    phases = Phases()
+    sourceJar = os.path.join(work, "spacehaven.jar")
+    modsPath = os.path.join(work, "mods")
+
+    start = time.perf_counter()
+    sizes = synthetic.make_jar(sourceJar, **sizes)
+    synthetic.make_mods(modsPath, sizes, count=mod_count, sprites=sprites)
+    phases.record("generate", time.perf_counter() - start)
+
+    phases.wrap(loader.assets.merge, "doMerges")
+    phases.wrap(loader.assets.merge, "doPatches")
+
+    # the loader keeps its caches in CACHE_ROOT of the working directory, the generated files are the game it sees
+    os.chdir(work)
+    for _ in range(repeat):
+        # the previous run left parsed trees in memory, cold phases must parse from disk
+        _release_warm_trees()
+        shutil.rmtree(os.path.join(work, loader.assets.cache.CACHE_ROOT), ignore_errors=True)
+        jarPath = _reset_game(work, sourceJar)
+        gameInfo, activeMods = _locate_mods(jarPath, modsPath)
+        modPaths = [mod.path for mod in activeMods]
+        profile = loader.assets.library.output_profile()
+
+        with phases.measure("vanilla cache"):
+            vanillaPath = loader.assets.cache.vanilla_library(jarPath, gameInfo.version)
+
+        phases.calls.clear()
+        with phases.measure("merge.mods"):
+            with loader.assets.library.VanillaLibrary(jarPath, vanillaPath) as vanilla:
+                modded = loader.assets.merge.mods(vanilla, activeMods, modPaths, profile=profile)
+        for function, elapsed in phases.calls.items():
+            phases.record("merge.mods/" + function, elapsed)
+
+        with phases.measure("library.patch"):
+            loader.assets.library.patch(jarPath, os.path.join(work, "patched.jar"), modded, profile=profile)
+        del modded
+
+        _release_warm_trees()
+        shutil.rmtree(os.path.join(work, loader.assets.cache.CACHE_ROOT), ignore_errors=True)
+        with phases.measure("load (cold)"):
+            loader.load.load(jarPath, activeMods, "benchmark", gameInfo.version)
+        loader.load.unload(jarPath)
+
+        # vanilla files and snapshots on disk, nothing parsed in memory
+        _release_warm_trees()
+        with phases.measure("load (warm)"):
+            loader.load.load(jarPath, activeMods, None, gameInfo.version)
+        loader.load.unload(jarPath)
+
+        # the core library parsed again in memory by the previous load, as when relaunching from the game
+        loader.assets.warm.TREES.wait()
+        with phases.measure("load (relaunch)"):
+            loader.load.load(jarPath, activeMods, None, gameInfo.version)
+        loader.load.unload(jarPath)
+
+        with phases.measure("quickload"):
+            loader.load.quickload(jarPath, "benchmark")
+        loader.load.unload(jarPath)
+
+    _release_warm_trees()
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+        },
+        "parameters": dict(sizes, mods=mod_count, sprites=sprites, repeat=repeat),
+        "jar_mb": os.path.getsize(sourceJar) / 2**20,
+        "phases": phases.results,
+    }
+
+
+def _print(results, previous=None):
+    print()
+    header = f"{'phase':<28} {'wall s':>8} {'peak MB':>8}"
+    if previous:
+        header += f" {'was s':>8} {'ratio':>7}"
+    print(header)
+
+    for name, result in results["phases"].items():
+        peak = "-" if result["peak_rss_mb"] is None else f"{result['peak_rss_mb']:.1f}"
+        line = f"{name:<28} {result['wall_s']:>8.2f} {peak:>8}"
+        if previous and name in previous["phases"]:
+            before = previous["phases"][name]["wall_s"]
+            line += f" {before:>8.2f} {result['wall_s'] / before if before else float('nan'):>7.2f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    for size, default in synthetic.DEFAULTS.items():
+        parser.add_argument("--" + size.replace("_", "-"), type=int, default=default, help=f"synthetic jar size (default: {default})")
+    parser.add_argument("--mods", type=int, default=4, help="number of synthetic mods (default: 4)")
+    parser.add_argument("--sprites", type=int, default=32, help="auto-packed textures per texture mod (default: 32)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of the pipeline, the best time of each phase is reported")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    parser.add_argument("--keep", action="store_true", help="keep the generated files and print where they are")
+    args = parser.parse_args()
+
+    if _rss() is None:
+        sys.exit("Cannot measure the memory of this process here, install psutil: pip install -r benchmarks/requirements.txt")
+
+    sizes = {size: getattr(args, size) for size in synthetic.DEFAULTS}
+    work = tempfile.mkdtemp(prefix="modloader-benchmark-")
+    # ui.log writes logs.txt next to sys.argv[0], keep it with the generated files rather than in the source tree
+    sys.argv[0] = os.path.join(work, os.path.basename(sys.argv[0]))
+    cwd = os.getcwd()
+    try:
+        results = run(work, sizes, args.mods, args.sprites, args.repeat)
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"Generated files kept in {work}", file=sys.stderr)
+        else:
+            shutil.rmtree(work, ignore_errors=True)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    _print(results, previous)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
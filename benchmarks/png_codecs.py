@@ -0,0 +1,93 @@
+"""Compare the png backends on the texture regions of a real spacehaven.jar
+
+    python -m benchmarks.png_codecs path/to/spacehaven.jar
+
+Encodes the regions listed in library/textures as png files at several compression levels
+with every installed backend of loader.assets.pngcodec, then decodes the files written by
+each backend with each backend.
+"""
+
+import argparse
+import io
+import os
+import tempfile
+import time
+
+import lxml.etree
+
+from loader.assets import pngcodec
+from loader.assets.explode import Texture
+from loader.assets.library import VanillaLibrary
+from loader.assets.utils import create_xml_parser
+
+
+def _regions(jarPath, limit):
+    """Pixel rows of up to `limit` regions, spread over all the cim pages"""
+
+    with VanillaLibrary(jarPath) as vanilla:
+        textures = lxml.etree.parse(io.BytesIO(vanilla.read("library/textures")), parser=create_xml_parser())
+        regions = textures.xpath("//re[@n]")
+        step = max(len(regions) // limit, 1)
+
+        pages = {}
+        result = []
+        for region in regions[::step][:limit]:
+            page = region.get("t")
+            if page not in pages:
+                pages[page] = Texture("library/{}.cim".format(page), data=vanilla.read("library/{}.cim".format(page)))
+            w, h = int(region.get("w")), int(region.get("h"))
+            if w and h:
+                rows = pages[page].region(int(region.get("x")), int(region.get("y")), w, h)
+                result.append((w, h, [bytes(row) for row in rows]))
+    return result
+
+
+def run(jarPath, backends, levels, limit):
+    regions = _regions(jarPath, limit)
+    pixels = sum(w * h for w, h, rows in regions)
+
+    encoded = []
+    decoded = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for writer in backends:
+            for level in levels:
+                paths = [os.path.join(tmp, "{}-{}-{}.png".format(writer, level, i)) for i in range(len(regions))]
+                start = time.perf_counter()
+                for path, (w, h, rows) in zip(paths, regions):
+                    pngcodec.write_rgba(path, w, h, rows, level, writer)
+                encoded.append((writer, level, time.perf_counter() - start, sum(os.path.getsize(path) for path in paths)))
+
+            # pypng writes unfiltered rows, other encoders (and image editors) filter them,
+            # which is what makes decoding costly: decode what every backend wrote
+            for reader in backends:
+                start = time.perf_counter()
+                for path in paths:
+                    pngcodec.read_rgba(path, reader)
+                decoded.append((reader, writer, time.perf_counter() - start))
+    return len(regions), pixels, encoded, decoded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("jar", help="path to a vanilla spacehaven.jar")
+    parser.add_argument("--regions", type=int, default=2000, help="number of regions to encode (default: 2000)")
+    parser.add_argument("--level", type=int, action="append", help="zlib level to compare, can be repeated (default: 1, 6 and 9)")
+    args = parser.parse_args()
+
+    backends = [backend for backend in pngcodec.BACKENDS if backend != "pillow" or pngcodec.PIL is not None]
+    count, pixels, encoded, decoded = run(args.jar, backends, args.level or [1, 6, 9], args.regions)
+
+    print()
+    print(f"{count} regions, {pixels * 4 / 2**20:.1f} MB of RGBA pixels")
+    print(f"{'encoder':<10} {'level':>5} {'encode s':>9} {'png MB':>8}")
+    for backend, level, elapsed, size in encoded:
+        print(f"{backend:<10} {level:>5} {elapsed:>9.2f} {size / 2**20:>8.1f}")
+
+    print()
+    print(f"{'decoder':<10} {'pngs from':<10} {'decode s':>9}")
+    for reader, writer, elapsed in decoded:
+        print(f"{reader:<10} {writer:<10} {elapsed:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""Synthetic spacehaven.jar and mods for the benchmarks
+
+The jar has the layout of the real one (library XML files, cim pages, audio and class files)
+with configurable sizes. The mods are shaped like the samples in mods/: merges of haven
+and texts definitions, patches with config variables, core texture overrides and
+auto-packed textures.
+"""
+
+import os
+import random
+import struct
+import zlib
+
+import png
+import zipfile39
+
+# haven sections and their id attribute, as in merge.doMerges
+HAVEN_SECTIONS = {
+    "BackPack": "mid",
+    "BackStory": "id",
+    "CelestialObject": "id",
+    "Character": "cid",
+    "CharacterCondition": "id",
+    "CharacterSet": "cid",
+    "CharacterTrait": "id",
+    "CostGroup": "id",
+    "Craft": "cid",
+    "DataLog": "id",
+    "DataLogFragment": "id",
+    "DefaultStuff": "id",
+    "DialogChoice": "id",
+    "DifficultySettings": "id",
+    "Effect": "id",
+    "Element": "mid",
+    "Encounter": "id",
+    "Explosion": "id",
+    "Faction": "id",
+    "FloorExpPackage": "id",
+    "GameScenario": "id",
+    "GOAPAction": "id",
+    "IdleAnim": "id",
+    "IsoFX": "id",
+    "Item": "mid",
+    "MainCat": "id",
+    "Monster": "cid",
+    "Notes": "id",
+    "ObjectiveCollection": "nid",
+    "PersonalitySettings": "id",
+    "Plan": "id",
+    "Product": "eid",
+    "Randomizer": "id",
+    "RandomShip": "id",
+    "Robot": "cid",
+    "RoofExpPackage": "id",
+    "Room": "rid",
+    "Sector": "id",
+    "Ship": "rid",
+    "SubCat": "id",
+    "Tech": "id",
+    "TechTree": "id",
+    "TradingValues": "id",
+}
+
+# the sections holding most of the definitions in the real game
+LARGE_SECTIONS = ("Element", "Item", "Product", "Tech")
+
+DEFAULTS = {
+    "elements": 3000,
+    "texts": 20000,
+    "animations": 3000,
+    "pages": 24,
+    "page_size": 1024,
+    "regions": 64,
+    "audio": 200,
+    "classes": 2000,
+}
+
+
+def _haven(rng, elements):
+    lines = ["<data>"]
+    for section, idAttribute in HAVEN_SECTIONS.items():
+        count = elements if section in LARGE_SECTIONS else max(elements // 100, 1)
+        lines.append("<{}>".format(section))
+        for i in range(count):
+            if section == "Element":
+                radius = rng.randint(1, 20)
+                lines.append(
+                    '<me mid="{0}"><name tid="{0}"/><data><l><element><features><powerGrid radius="{1}" capacity="{2}"/></features>'
+                    '<solar powerPerSec="{1}"/></element></l></data><linked><l id="{3}"/></linked></me>'.format(i, radius, radius * 10, rng.randrange(count))
+                )
+            elif section == "Product":
+                lines.append('<product eid="{0}"><products><l element="34" howMuch="{1}"/><l element="{2}" howMuch="1"/></products></product>'.format(i, rng.randint(1, 9), rng.randrange(elements)))
+            else:
+                lines.append('<me {0}="{1}"><name tid="{1}"/><values v1="{2}" v2="{3}"/></me>'.format(idAttribute, i, rng.random(), rng.randrange(1000)))
+        lines.append("</{}>".format(section))
+    lines.append("</data>")
+    return "\n".join(lines)
+
+
+def _texts(count):
+    return "\n".join(["<t>"] + ['<t id="{0}"><EN>Text number {0}</EN><DE>Text Nummer {0}</DE></t>'.format(i) for i in range(count)] + ["</t>"])
+
+
+def _animations(count):
+    return "\n".join(["<AllAnimations><animations>"] + ['<a n="{0}"><assetPos a="{0}" x="0" y="0"/></a>'.format(i) for i in range(count)] + ["</animations></AllAnimations>"])
+
+
+def _grid(page_size, regions):
+    """Square grid of `regions` cells covering a page, as (x, y, size) tuples"""
+
+    per_row = 1
+    while per_row * per_row < regions:
+        per_row += 1
+    size = page_size // per_row
+    return [((i % per_row) * size, (i // per_row) * size, size) for i in range(regions)]
+
+
+def _textures(pages, page_size, regions):
+    lines = ["<AllTexturesAndRegions><textures>"]
+    lines += ['<t i="{}" w="{}" h="{}"/>'.format(page, page_size, page_size) for page in range(pages)]
+    lines.append("</textures><regions>")
+    n = 0
+    for page in range(pages):
+        for x, y, size in _grid(page_size, regions):
+            lines.append('<re n="{}" t="{}" x="{}" y="{}" w="{}" h="{}"/>'.format(n, page, x, y, size, size))
+            n += 1
+    lines.append("</regions></AllTexturesAndRegions>")
+    return "\n".join(lines)
+
+
+def _audio(count):
+    lines = ["<audio>"]
+    for i in range(count):
+        if i % 4:
+            lines.append('<a id="{0}" at="Sound" n="sound{0}" ogg="library/sound/sound{0}.ogg"/>'.format(i))
+        else:
+            lines.append('<a id="{0}" at="Music" n="music{0}" ogg="library/music/music{0}.ogg"/>'.format(i))
+    lines.append("</audio>")
+    return "\n".join(lines)
+
+
+def _cim(rng, page_size):
+    # flat colored cells and transparent gaps, compresses about like the real pages
+    cells = []
+    for _ in range(page_size // 16):
+        if rng.random() < 0.7:
+            cells.append(bytes((rng.randrange(256), rng.randrange(256), rng.randrange(256), 255)) * 16)
+        else:
+            cells.append(bytes(64))
+    row = b"".join(cells)
+
+    data = bytearray()
+    for y in range(page_size):
+        if y % 16 == 0:
+            shift = rng.randrange(len(cells)) * 64
+        data += row[shift:] + row[:shift]
+    return zlib.compress(struct.pack(">iii", page_size, page_size, 4) + bytes(data))
+
+
+def make_jar(jarPath, seed=0, **sizes):
+    """Write a synthetic spacehaven.jar, see `DEFAULTS` for the `sizes` that can be set"""
+
+    sizes = dict(DEFAULTS, **sizes)
+    rng = random.Random(seed)
+
+    with zipfile39.ZipFile(jarPath, "w", zipfile39.ZIP_DEFLATED) as jar:
+        jar.writestr("version.txt", "0.0.0-benchmark\nalpha 0\n")
+        jar.writestr("library/", b"")
+        jar.writestr("library/haven", _haven(rng, sizes["elements"]))
+        jar.writestr("library/texts", _texts(sizes["texts"]))
+        jar.writestr("library/animations", _animations(sizes["animations"]))
+        jar.writestr("library/textures", _textures(sizes["pages"], sizes["page_size"], sizes["regions"]))
+        jar.writestr("library/audio", _audio(sizes["audio"]))
+        jar.writestr("library/gfiles", "<gfiles/>")
+
+        # cim pages and audio are already compressed, the game stores them as-is
+        for page in range(sizes["pages"]):
+            jar.writestr("library/{}.cim".format(page), _cim(rng, sizes["page_size"]), zipfile39.ZIP_STORED)
+        for i in range(sizes["audio"]):
+            folder = "music" if i % 4 == 0 else "sound"
+            jar.writestr("library/{0}/{0}{1}.ogg".format(folder, i), rng.randbytes(rng.randint(5000, 50000)), zipfile39.ZIP_STORED)
+
+        for i in range(sizes["classes"]):
+            jar.writestr("fi/bugbyte/spacehaven/C{}.class".format(i), rng.randbytes(400) + b"\0" * rng.randint(500, 8000))
+
+    return sizes
+
+
+def _write_png(path, width, height, rgba):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    row = list(rgba) * width
+    with open(path, "wb") as f:
+        png.Writer(width, height, greyscale=False, alpha=True).write(f, [row] * height)
+
+
+def _info(path, name, modid=None, variables=()):
+    config = "".join('<var name="{{{}}}" default="{}">{}</var>'.format(var, value, var) for var, value in variables)
+    with open(path, "w") as f:
+        f.write(
+            "<mod><name>{}</name><description>Synthetic benchmark mod</description><minimumLoaderVersion>0.1.0</minimumLoaderVersion>"
+            "<version>1</version>{}{}</mod>".format(name, "<modid>{}</modid>".format(modid) if modid else "", "<config>{}</config>".format(config) if config else "")
+        )
+
+
+def make_mods(modsPath, sizes, count=4, sprites=32, seed=0):
+    """Write `count` synthetic mods for a jar made by `make_jar` with `sizes`
+
+    Mods cycle through the shapes of the sample mods: a haven/texts merge (greenhouse),
+    a patch mod with config variables (Electric Slide), a core texture override, and a mod
+    with `sprites` auto-packed textures.
+    """
+
+    rng = random.Random(seed)
+    elements = sizes["elements"]
+    region_size = _grid(sizes["page_size"], sizes["regions"])[0][2]
+
+    for index in range(count):
+        kind = index % 4
+        modPath = os.path.join(modsPath, "benchmark-{}-{}".format(index, ("merge", "patch", "override", "autopack")[kind]))
+        os.makedirs(os.path.join(modPath, "library"), exist_ok=True)
+
+        if kind == 0:
+            _info(os.path.join(modPath, "info"), os.path.basename(modPath))
+            changed = rng.sample(range(elements), min(elements, 200))
+            with open(os.path.join(modPath, "library", "haven"), "w") as f:
+                f.write("<data><Element>")
+                f.write("".join('<me mid="{0}"><name tid="{0}"/><data><l><element><features><powerGrid radius="5" capacity="50"/></features></element></l></data></me>'.format(i) for i in changed))
+                f.write("".join('<me mid="{}"><name tid="1"/></me>'.format(elements + 1000 * index + i) for i in range(50)))
+                f.write("</Element><Item>")
+                f.write("".join('<me mid="{}"><values v1="0"/></me>'.format(i) for i in changed[:50]))
+                f.write("</Item></data>")
+            with open(os.path.join(modPath, "library", "texts"), "w") as f:
+                f.write("<t>" + "".join('<t id="{0}"><EN>Modded text {0}</EN></t>'.format(i) for i in changed) + "</t>")
+
+        elif kind == 1:
+            variables = [("GeneratorOutput", "2"), ("SolarOutput", "3"), ("PowerRadius", "1.5")]
+            _info(os.path.join(modPath, "info.xml"), os.path.basename(modPath), variables=variables)
+            os.makedirs(os.path.join(modPath, "patches"), exist_ok=True)
+            with open(os.path.join(modPath, "patches", "haven_benchmark.xml"), "w") as f:
+                f.write("<Patch>")
+                for xpath, attribute, var in (
+                    ('/data/Product/product/products/l[@element="34"][@howMuch]', "howMuch", "GeneratorOutput"),
+                    ("/data/Element/me/data/l/element/solar[@powerPerSec]", "powerPerSec", "SolarOutput"),
+                    ("/data/Element/me/data/l/element/features/powerGrid[@radius]", "radius", "PowerRadius"),
+                ):
+                    f.write('<Operation Class="AttributeMath"><xpath>{}</xpath><attribute>{}</attribute><value opType="multiply">{{{}}}</value></Operation>'.format(xpath, attribute, var))
+                f.write('<Operation Class="NodeAdd"><xpath>/data/Tech/me[@id&lt;50]</xpath><value> <extra a="1"/></value></Operation>')
+                f.write('<Operation Class="AttributeSet"><xpath>/data/Item/me/values</xpath><attribute>v2</attribute><value>7</value></Operation>')
+                f.write("</Patch>")
+
+        elif kind == 2:
+            _info(os.path.join(modPath, "info"), os.path.basename(modPath))
+            # one region per page, so that every cim page gets modded
+            total = sizes["pages"] * sizes["regions"]
+            regions = [page * sizes["regions"] + rng.randrange(sizes["regions"]) for page in range(sizes["pages"])]
+            with open(os.path.join(modPath, "library", "textures"), "w") as f:
+                f.write("<AllTexturesAndRegions><textures/><regions>")
+                for region in regions:
+                    page = region // sizes["regions"]
+                    x, y, size = _grid(sizes["page_size"], sizes["regions"])[region % sizes["regions"]]
+                    f.write('<re n="{}.png" t="{}" x="{}" y="{}" w="{}" h="{}"/>'.format(region, page, x, y, size, size))
+                f.write("</regions></AllTexturesAndRegions>")
+            for region in regions:
+                _write_png(os.path.join(modPath, "textures", "{}.png".format(region)), region_size, region_size, (rng.randrange(256), 0, 0, 255))
+            with open(os.path.join(modPath, "library", "animations"), "w") as f:
+                f.write('<AllAnimations><animations><a n="{0}"><assetPos a="{0}"/></a></animations></AllAnimations>'.format(total - 1))
+
+        else:
+            _info(os.path.join(modPath, "info"), os.path.basename(modPath), modid=900 + index)
+            assets = []
+            for i in range(sprites):
+                _write_png(os.path.join(modPath, "textures", "sprite{}.png".format(i)), rng.randint(16, 128), rng.randint(16, 128), (0, rng.randrange(256), 0, 255))
+                assets.append('<assetPos a="0" filename="sprite{}"/>'.format(i))
+            with open(os.path.join(modPath, "library", "animations"), "w") as f:
+                f.write('<AllAnimations><animations><a n="benchmark{}">{}</a></animations></AllAnimations>'.format(index, "".join(assets)))
+            with open(os.path.join(modPath, "library", "haven"), "w") as f:
+                f.write('<data><Element><me mid="{}"><name tid="1"/></me></Element></data>'.format(elements + 1000 * index))
@@ -0,0 +1,109 @@
+"""Cache of the texture pages auto-packed from the mod textures, reused across builds"""
+
+import json
+import os
+import shutil
+
+import ui.log
+
+import loader.clone
+
+from .cache import CACHE_ROOT
+from .explode import Texture, texture_hash
+
+ATLAS_CACHE_PATH = os.path.join(CACHE_ROOT, "atlas")
+
+# Number of packings kept, the least recently used ones are removed
+ATLAS_CACHE_ENTRIES = 4
+
+LAYOUT_FILE = "layout.json"
+
+# bump to invalidate every cached atlas when their layout or format changes
+ATLAS_FORMAT = 2
+
+
+def content_key(files, parameters):
+    """Hash of the packing `parameters` and of the names, sizes and contents of the (name, path) `files`"""
+
+    sha = texture_hash()
+    sha.update("{}:{}".format(ATLAS_FORMAT, ":".join(str(p) for p in parameters)).encode("utf-8"))
+    for name, path in sorted(files):
+        sha.update("\0{}\0{}\0".format(name, os.path.getsize(path)).encode("utf-8"))
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _entry_path(key):
+    return os.path.join(ATLAS_CACHE_PATH, key[:16])
+
+
+def load(key):
+    """Return the (layout, pages) cached under `key`, None if there are none
+
+    `pages` are the composited texture pages, as `Texture` objects.
+    """
+
+    entryPath = _entry_path(key)
+    layoutPath = os.path.join(entryPath, LAYOUT_FILE)
+    try:
+        with open(layoutPath, "r") as f:
+            entry = json.load(f)
+        if entry.get("key") != key:
+            return None
+        pages = []
+        for page in range(entry["pages"]):
+            cimPath = os.path.join(entryPath, "{}.cim".format(page))
+            with open(cimPath, "rb") as f:
+                pages.append(Texture(cimPath, data=f.read()))
+    except (OSError, ValueError, KeyError):
+        return None
+
+    # mark as recently used
+    os.utime(layoutPath)
+    ui.log.log("  Reusing packed textures from {}".format(entryPath))
+    return entry["layout"], pages
+
+
+def store(key, layout, pages):
+    """Keep the `layout` and the composited `pages` of a packing
+
+    The pages are also written as png files, to look at what was packed.
+    """
+
+    entryPath = _entry_path(key)
+    # the entry only appears once complete
+    with loader.clone.atomic_write(entryPath) as partialPath:
+        os.makedirs(partialPath)
+        for index, page in enumerate(pages):
+            with open(os.path.join(partialPath, "{}.cim".format(index)), "wb") as f:
+                f.write(page.export_cim_bytes(os.path.join(entryPath, "{}.cim".format(index))))
+            page.export_png(os.path.join(partialPath, "{}.png".format(index)))
+        with open(os.path.join(partialPath, LAYOUT_FILE), "w") as f:
+            json.dump({"key": key, "pages": len(pages), "layout": layout}, f)
+        shutil.rmtree(entryPath, ignore_errors=True)
+    ui.log.log("  Stored packed textures in {}".format(entryPath))
+    _evict()
+
+
+def _evict():
+    """Remove the least recently used packings beyond ATLAS_CACHE_ENTRIES"""
+
+    entries = []
+    for entry in os.listdir(ATLAS_CACHE_PATH):
+        layoutPath = os.path.join(ATLAS_CACHE_PATH, entry, LAYOUT_FILE)
+        if os.path.isfile(layoutPath):
+            entries.append((os.path.getmtime(layoutPath), entry))
+        else:
+            # entries of an older format, or left over by an interrupted build
+            entries.append((0, entry))
+
+    entries.sort(reverse=True)
+    for mtime, entry in entries[ATLAS_CACHE_ENTRIES:]:
+        ui.log.log("  Evicting packed textures {}".format(entry))
+        path = os.path.join(ATLAS_CACHE_PATH, entry)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+import shutil
+
+import zipfile39
+import ui.log
+
+import loader.clone
+
+# Every cache of the mod loader is kept in this folder of its working directory
+CACHE_ROOT = "cache"
+
+VANILLA_CACHE_PATH = os.path.join(CACHE_ROOT, "vanilla")
+
+FINGERPRINT_FILE = "fingerprint.json"
+
+
+def fingerprint(jarPath, gameVersion):
+    """Identify a spacehaven.jar by its size, mtime, contents and game version"""
+
+    stat = os.stat(jarPath)
+
+    # the central directory holds the crc32 of every entry, hashing it is as good
+    # as hashing the whole jar and only costs a few hundred kilobytes of reading
+    with zipfile39.ZipFile(jarPath, "r") as spacehaven:
+        spacehaven.fp.seek(spacehaven.start_dir)
+        content_hash = hashlib.sha1(spacehaven.fp.read()).hexdigest()
+
+    return {
+        "version": gameVersion,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "content": content_hash,
+    }
+
+
+def fingerprint_key(jarFingerprint):
+    text = "__".join(str(jarFingerprint[k]) for k in sorted(jarFingerprint))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def vanilla_library(jarPath, gameVersion):
+    """Return the directory where the vanilla library files of `jarPath` are extracted
+
+    Files are only extracted when a build needs them (see `VanillaLibrary`), and reused across
+    launches until the jar changes, at which point the previous extractions are evicted.
+    The directory must be treated as read-only outside of `VanillaLibrary`.
+    """
+
+    jarFingerprint = fingerprint(jarPath, gameVersion)
+    key = fingerprint_key(jarFingerprint)
+    cachePath = os.path.join(VANILLA_CACHE_PATH, key)
+    fingerprintPath = os.path.join(cachePath, FINGERPRINT_FILE)
+
+    if os.path.isfile(fingerprintPath):
+        ui.log.log("  Reusing vanilla library cache {}".format(cachePath))
+        return cachePath
+
+    _evict()
+    os.makedirs(cachePath)
+
+    # every file of the cache is written next to its final location and renamed once
+    # complete, so an interrupted launch never leaves a truncated file behind
+    with loader.clone.atomic_write(fingerprintPath) as partial, open(partial, "w") as f:
+        json.dump(jarFingerprint, f, indent=4)
+
+    ui.log.log("  Created vanilla library cache {}".format(cachePath))
+    return cachePath
+
+
+def _evict():
+    """Remove all cached vanilla libraries, they belong to a previous game version"""
+
+    if not os.path.isdir(VANILLA_CACHE_PATH):
+        return
+
+    for entry in os.listdir(VANILLA_CACHE_PATH):
+        ui.log.log("  Evicting vanilla library cache {}".format(entry))
+        shutil.rmtree(os.path.join(VANILLA_CACHE_PATH, entry), ignore_errors=True)
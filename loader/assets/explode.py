@@ -1,41 +1,92 @@
+import concurrent.futures
 import hashlib
-import io
+import json
+import multiprocessing
 import os
+import shutil
 import struct
 import zlib
 
 import lxml.etree
-import png
 import ui.log
 
+import loader.clone
+from loader import settings
+from loader.assets import pngcodec
 from loader.assets.utils import create_xml_parser
 
+# NumPy is optional, without it pixels are copied row by row in pure Python.
+# MODLOADER_PIXEL_BACKEND=python forces the fallback even when NumPy is installed.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if settings.env_choice("MODLOADER_PIXEL_BACKEND", ("numpy", "python"), "numpy") == "python":
+    numpy = None
+
+EXPLODED_DIR = "textures.exploded"
+
+# page hashes and region rectangles of the pngs in EXPLODED_DIR, to only write what changed
+MANIFEST_FILE = "manifest.json"
+
+# exploded pngs are only there to be looked at, favour writing them fast over their size.
+# MODLOADER_EXPLODE_PNG_LEVEL sets the zlib level, from 0 to 9
+EXPLODE_PNG_LEVEL = 1
+
 PIXEL_SIZE = 4
 RGBA_FORMAT = 4
 HEADER_SIZE = 12
 
-"""
-alt code for png
-        if 0:
-            from PIL import Image
-            reader = Image.open(path)
-            print(reader.format, reader.size, reader.mode)
-            width, height = reader.size
-            img_data = reader.getdata()
-            for row_idx in range(height):
-                start = (x + ((row_idx + y) * width)) * PIXEL_SIZE + HEADER_SIZE
-                end = start + (width * PIXEL_SIZE)
-                # FIXME might be tricky to get the image in the correct format ...
-        else:
-"""
+# cim pages are inflated and deflated this many bytes at a time
+CIM_CHUNK_SIZE = 1024 * 1024
+
+# Hashes of the decoded cim pages, only computed for the log when MODLOADER_CIM_HASH names one
+CIM_HASHES = ("crc32", "blake2")
+
+
+class _Crc32:
+    """zlib.crc32 behind the hashlib interface"""
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return "%08x" % self.value
+
+
+def texture_hash(name="blake2"):
+    """New incremental hash of texture data, the texture caches are keyed on blake2"""
+    if name == "crc32":
+        return _Crc32()
+    return hashlib.blake2b(digest_size=20)
+
+
+CIM_HASH = settings.env_choice("MODLOADER_CIM_HASH", CIM_HASHES, None)
+
+
+def _read_chunks(path, data=None):
+    """Compressed contents of a cim file, in chunks"""
+    if data is not None:
+        view = memoryview(data)
+        for start in range(0, len(view), CIM_CHUNK_SIZE):
+            end = start + CIM_CHUNK_SIZE
+            yield view[start:end]
+        return
+    with open(path, "rb") as cim:
+        for chunk in iter(lambda: cim.read(CIM_CHUNK_SIZE), b""):
+            yield chunk
 
 
 class Texture:
-    def __init__(self, path, create=False, width=None, height=None):
+    def __init__(self, path, create=False, width=None, height=None, data=None):
         if create:
             return self._init_cim(width, height)
         else:
-            return self._import_cim(path)
+            return self._import_cim(path, data)
 
     def _init_cim(self, width, height):
         self.width = int(width)
@@ -47,31 +98,98 @@ class Texture:
         struct.pack_into(">i", self.header, 8, RGBA_FORMAT)
 
         self.data = bytearray(self.width * self.height * PIXEL_SIZE)
+        self._init_pixels()
+
+    def _import_cim(self, path, data=None):
+        """Decode the cim file at `path`, or its already loaded contents `data`
+
+        The page is inflated a chunk at a time straight into `data`, allocated once from the
+        size in the header, so the decoded image is never copied as a whole.
+        """
+        decompressor = zlib.decompressobj()
+        digest = texture_hash(CIM_HASH) if CIM_HASH else None
+        header = bytearray()
+        self.data = None
+        offset = 0
+
+        def _inflated():
+            for chunk in _read_chunks(path, data):
+                while chunk:
+                    yield decompressor.decompress(chunk, CIM_CHUNK_SIZE)
+                    chunk = decompressor.unconsumed_tail
+            yield decompressor.flush()
+
+        for inflated in _inflated():
+            if digest is not None:
+                digest.update(inflated)
+
+            if self.data is None:
+                header += inflated
+                if len(header) < HEADER_SIZE:
+                    continue
+                inflated = memoryview(header)[HEADER_SIZE:]
+                if not self._init_header(bytes(header[:HEADER_SIZE])):
+                    return
+                self.data = bytearray(self.width * self.height * PIXEL_SIZE)
+
+            end = offset + len(inflated)
+            self.data[offset:end] = inflated
+            offset = end
+
+        if self.data is None:
+            ui.log.log("ERROR: Truncated CIM file: {}".format(path))
+            return
+        if digest is not None:
+            ui.log.log("  %s vanilla %s %s %d bytes" % (os.path.split(path)[1], CIM_HASH, digest.hexdigest(), HEADER_SIZE + offset))
 
-    def _import_cim(self, path):
-        data = io.BytesIO(zlib.decompress(open(path, "rb").read()))
-        md5 = hashlib.md5(data.getbuffer()).hexdigest()
-        ui.log.log("  %s vanilla md5 %s %d bytes" % (os.path.split(path)[1], md5, data.getbuffer().nbytes))
+        expected_size = self.width * self.height * PIXEL_SIZE
+        if offset != expected_size:
+            del self.data[offset:]
+            ui.log.log("ERROR: Wrong size %s: %d vs %d" % (path, offset, expected_size))
+        self._init_pixels()
 
-        self.header = data.read(HEADER_SIZE)
+    def _init_header(self, header):
+        self.header = header
         self.width = struct.unpack_from(">i", self.header)[0]
         self.height = struct.unpack_from(">i", self.header, offset=4)[0]
         self.format = struct.unpack_from(">i", self.header, offset=8)[0]
 
         if self.format == RGBA_FORMAT:
             self.mode = "RGBA"
-        else:
-            ui.log.log("ERROR: Unknown CIM format: {}".format(self.format))
-            return
+            return True
+        ui.log.log("ERROR: Unknown CIM format: {}".format(self.format))
+        return False
+
+    def _init_pixels(self):
+        """With NumPy, view `data` as a height x width x RGBA array sharing its memory"""
+        self.pixels = None
+        if numpy is not None and len(self.data) == self.width * self.height * PIXEL_SIZE:
+            self.pixels = numpy.frombuffer(self.data, dtype=numpy.uint8).reshape(self.height, self.width, PIXEL_SIZE)
+
+    def region(self, x=0, y=0, width=None, height=None):
+        """Rows of pixels of a region, as views into `data` rather than copies"""
+        if width is None:
+            width = self.width
+        if height is None:
+            height = self.height
 
-        self.data = bytearray(data.read())
-        expected_size = self.width * self.height * PIXEL_SIZE
-        if len(self.data) != expected_size:
-            ui.log.log("ERROR: Wrong size %s: %d vs %d" % (path, len(self.data), expected_size))
+        if self.pixels is not None:
+            bottom = y + height
+            right = x + width
+            return self.pixels[y:bottom, x:right].reshape(height, width * PIXEL_SIZE)
+
+        view = memoryview(self.data)
+        rows = []
+        for row in range(height):
+            start = (x + ((row + y) * self.width)) * PIXEL_SIZE
+            end = start + (width * PIXEL_SIZE)
 
-    def pack_png(self, path, x=0, y=0, w=0, h=0):
-        reader = png.Reader(filename=path)
-        (width, height, rows, info) = reader.asRGBA()
+            rows.append(view[start:end])
+        return rows
+
+    def pack_png(self, path, x=0, y=0, w=0, h=0, images=None):
+        """Copy a png file into the texture, decoded through the `images` cache if given"""
+        (width, height, data) = (images or pngcodec).read_rgba(path)
         if w and w != width:
             ui.log.log("ERROR: Wrong width in %s: %d vs %d" % (path, width, w))
             return
@@ -79,75 +197,184 @@ class Texture:
             ui.log.log("ERROR: Wrong width in %s: %d vs %d" % (path, height, h))
             return
 
-        row_idx = 0
-        for row in rows:
-            start = (x + ((row_idx + y) * self.width)) * PIXEL_SIZE
-            end = start + (width * PIXEL_SIZE)
+        if self.pixels is not None:
+            # one strided copy of the whole image instead of a slice assignment per row
+            self.region(x, y, width, height)[:] = numpy.frombuffer(data, dtype=numpy.uint8).reshape(height, width * PIXEL_SIZE)
+        else:
+            view = memoryview(data)
+            stride = width * PIXEL_SIZE
+            for row_idx in range(height):
+                start = (x + ((row_idx + y) * self.width)) * PIXEL_SIZE
+                end = start + stride
+                row_start = row_idx * stride
+                row_end = row_start + stride
 
-            self.data[start:end] = row
-            row_idx += 1
+                self.data[start:end] = view[row_start:row_end]
         ui.log.log("  Repacked {}...".format(os.path.split(path)[1]))
 
-    def export_cim(self, path):
-        export = self.header + self.data
-        md5 = hashlib.md5(export).hexdigest()
-        ui.log.log("  %s MODDED md5 %s %d bytes" % (os.path.split(path)[1], md5, len(export)))
+    def _compressed_chunks(self, path, level):
+        """Deflate the header and pixels as they are, without first joining them into one buffer"""
+        if CIM_HASH:
+            digest = texture_hash(CIM_HASH)
+            digest.update(self.header)
+            digest.update(self.data)
+            ui.log.log("  %s MODDED %s %s %d bytes" % (os.path.split(path)[1], CIM_HASH, digest.hexdigest(), len(self.header) + len(self.data)))
+
+        compressor = zlib.compressobj(level)
+        yield compressor.compress(self.header)
+        view = memoryview(self.data)
+        for start in range(0, len(view), CIM_CHUNK_SIZE):
+            end = start + CIM_CHUNK_SIZE
+            yield compressor.compress(view[start:end])
+        yield compressor.flush()
+
+    def export_cim_bytes(self, path, level=zlib.Z_DEFAULT_COMPRESSION):
+        """Return the compressed cim file contents, `path` is only used for logging"""
+        return b"".join(self._compressed_chunks(path, level))
+
+    def export_cim(self, path, level=zlib.Z_DEFAULT_COMPRESSION):
         with open(path, "wb") as cim:
-            cim.write(zlib.compress(export))
+            for chunk in self._compressed_chunks(path, level):
+                cim.write(chunk)
 
-    def export_png(self, path, x=0, y=0, width=None, height=None):
+    def export_png(self, path, x=0, y=0, width=None, height=None, level=None):
+        """Write a region as a png file, `level` is the zlib compression level"""
         if width is None:
             width = self.width
         if height is None:
             height = self.height
 
-        rows = []
-        for row in range(height):
-            start = (x + ((row + y) * self.width)) * PIXEL_SIZE
-            end = start + (width * PIXEL_SIZE)
+        pngcodec.write_rgba(path, width, height, self.region(x, y, width, height), level)
 
-            rows.append(self.data[start:end])
 
-        with open(path, "wb") as file:
-            writer = png.Writer(width=width, height=height, greyscale=False, alpha=True)
-            writer.write_packed(file, rows)
+def _explode_page(corePath, page, regions, whole_page=True, level=EXPLODE_PNG_LEVEL):
+    """Write the `regions` of one cim page and the whole page as png files, in a worker process"""
+    texture = Texture(os.path.join(corePath, "library", "{}.cim".format(page)))
 
+    explodedPath = os.path.join(corePath, "library", EXPLODED_DIR)
+    os.makedirs(os.path.join(explodedPath, page), exist_ok=True)
 
-def explode(corePath):
-    """Decode textures and write them out as individual regions"""
+    for name, x, y, w, h in regions:
+        texture.export_png(os.path.join(explodedPath, page, "{}.png".format(name)), x, y, w, h, level)
+    if whole_page:
+        texture.export_png(os.path.join(explodedPath, "{}.png".format(page)), level=level)
+    return len(regions)
 
-    textures = lxml.etree.parse(os.path.join(corePath, "library", "textures"), parser=create_xml_parser())
-    cims = {}
-    # export_cims = {}
 
-    regions = textures.xpath("//re[@n]")
+def _file_hash(path):
+    sha = texture_hash()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
 
-    ui.log.log("  Exploding textures at {}...".format(corePath))
 
-    for region in regions:
-        name = region.get("n")
+def _load_manifest(explodedPath):
+    try:
+        with open(os.path.join(explodedPath, MANIFEST_FILE), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
 
-        x = int(region.get("x"))
-        y = int(region.get("y"))
-        w = int(region.get("w"))
-        h = int(region.get("h"))
 
-        page = region.get("t")
+def _reuse(source, target):
+    """Keep or copy an up to date png, False if it has to be written again"""
+    if source == target:
+        return os.path.isfile(target)
+    if not os.path.isfile(source):
+        return False
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.copyfile(source, target)
+    return True
 
-        if page not in cims:
-            cim_filename = "{}.cim".format(page)
-            ui.log.updateBackgroundState("Unpacking textures ({})".format(cim_filename))
-            cims[page] = Texture(os.path.join(corePath, "library", cim_filename))
 
-        try:
-            os.makedirs(os.path.join(corePath, "library", "textures.exploded", page))
-        except FileExistsError:
-            pass
+def explode(corePath, workers=None, previousPath=None):
+    """Decode textures and write them out as individual regions
 
-        png_filename = os.path.join(corePath, "library", "textures.exploded", page, "{}.png".format(name))
-        cims[page].export_png(png_filename, x, y, w, h)
+    Only the pngs of pages whose cim changed, and of regions that are new or moved, are written
+    again. Without a previous run in `corePath`, up to date pngs are copied from the extraction
+    of another game version at `previousPath` if there is one. Every cim page that has pngs to
+    write is decoded by its own task, on `workers` processes.
+    """
 
-    for page in cims:
-        cims[page].export_png(os.path.join(corePath, "library", "textures.exploded", "{}.png".format(page)))
+    textures = lxml.etree.parse(os.path.join(corePath, "library", "textures"), parser=create_xml_parser())
 
-    ui.log.log("    Wrote {} texture regions".format(len(regions)))
+    pages = {}
+    for region in textures.xpath("//re[@n]"):
+        pages.setdefault(region.get("t"), {})[region.get("n")] = [int(region.get(key)) for key in ("x", "y", "w", "h")]
+
+    explodedPath = os.path.join(corePath, "library", EXPLODED_DIR)
+    manifest = {
+        "pages": {page: _file_hash(os.path.join(corePath, "library", "{}.cim".format(page))) for page in pages},
+        "regions": pages,
+    }
+
+    sourcePath = explodedPath
+    previous = _load_manifest(explodedPath)
+    if previous is None and previousPath:
+        sourcePath = os.path.join(previousPath, "library", EXPLODED_DIR)
+        previous = _load_manifest(sourcePath)
+    if previous is None:
+        previous = {"pages": {}, "regions": {}}
+    else:
+        ui.log.log("  Reusing unchanged textures from {}".format(sourcePath))
+
+    # pages to decode, with the regions to write and whether the whole page png is needed
+    tasks = {}
+    reused = 0
+    for page, regions in pages.items():
+        unchanged_page = previous["pages"].get(page) == manifest["pages"][page]
+        previous_regions = previous["regions"].get(page, {})
+
+        todo = []
+        for name, rect in regions.items():
+            png_name = os.path.join(page, "{}.png".format(name))
+            if unchanged_page and previous_regions.get(name) == rect and _reuse(os.path.join(sourcePath, png_name), os.path.join(explodedPath, png_name)):
+                reused += 1
+            else:
+                todo.append((name, *rect))
+
+        png_name = "{}.png".format(page)
+        whole_page = not (unchanged_page and _reuse(os.path.join(sourcePath, png_name), os.path.join(explodedPath, png_name)))
+        if todo or whole_page:
+            tasks[page] = (todo, whole_page)
+
+    # anything else in the tree belongs to regions or pages that are gone
+    expected = set(os.path.join(page, "{}.png".format(name)) for page, regions in pages.items() for name in regions)
+    expected.update("{}.png".format(page) for page in pages)
+    for root, dirs, files in os.walk(explodedPath, topdown=False):
+        for filename in files:
+            path = os.path.join(root, filename)
+            if filename.endswith(".png") and os.path.relpath(path, explodedPath) not in expected:
+                os.remove(path)
+        if root != explodedPath and not os.listdir(root):
+            os.rmdir(root)
+
+    workers = min(settings.workers("MODLOADER_EXPLODE_WORKERS", workers), max(len(tasks), 1))
+    level = settings.env_int("MODLOADER_EXPLODE_PNG_LEVEL", EXPLODE_PNG_LEVEL, minimum=0, maximum=9)
+    ui.log.log("  Exploding textures at {}: {} pages to unpack on {} processes...".format(corePath, len(tasks), workers))
+
+    def _progress(done):
+        ui.log.updateBackgroundState("Unpacking textures ({}/{} pages)".format(done, len(tasks)))
+
+    written = 0
+    if workers == 1:
+        for done, (page, (regions, whole_page)) in enumerate(tasks.items()):
+            _progress(done)
+            written += _explode_page(corePath, page, regions, whole_page, level)
+    else:
+        # spawned rather than forked on every platform: forking the threads of the ui could copy held locks
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(_explode_page, corePath, page, regions, whole_page, level) for page, (regions, whole_page) in tasks.items()]
+            _progress(0)
+            for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                written += future.result()
+                _progress(done)
+
+    # only record the new state once every png matches it
+    os.makedirs(explodedPath, exist_ok=True)
+    manifestPath = os.path.join(explodedPath, MANIFEST_FILE)
+    with loader.clone.atomic_write(manifestPath) as partial, open(partial, "w") as f:
+        json.dump(manifest, f)
+
+    ui.log.log("    Wrote {} texture regions, {} unchanged".format(written, reused))
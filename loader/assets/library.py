@@ -1,7 +1,23 @@
+import concurrent.futures
+import copy
+import functools
+import io
 import os
+import shutil
+import struct
+import time
+import zlib
+
+import lxml.etree
 import zipfile39
 import ui.log
 
+import loader.clone
+from loader import settings
+
+from . import warm
+from .utils import create_xml_parser
+
 PATCHABLE_XML_FILES = [
     "library/haven",
     "library/texts",
@@ -12,6 +28,163 @@ PATCHABLE_XML_FILES = [
 
 PATCHABLE_CIM_FILES = ["library/%d.cim" % i for i in range(24)]
 
+# The parsed XML files are saved in the cache without the whitespace between elements, which
+# parses faster than the original. Bump to rebuild the snapshots when the way they are written changes.
+SNAPSHOT_FORMAT = 1
+
+# Size of the chunks used when streaming entries from one jar to another
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Modded entries are deflated in blocks of this size, in parallel
+DEFLATE_BLOCK_SIZE = 1024 * 1024
+_DEFLATE_WINDOW_SIZE = 32 * 1024
+
+# Modded entries that already hold compressed data, deflating them again only costs time
+STORED_EXTENSIONS = (".cim", ".ogg", ".mp3")
+
+# How hard the modded jar entries and cim pages get compressed. The patched jars are local,
+# short-lived and rebuilt often, so build speed matters more than their size by default.
+# "store" leaves the jar entries uncompressed, the cim pages are always zlib streams.
+OUTPUT_PROFILES = {
+    "store": {"compress_type": zipfile39.ZIP_STORED, "jar_level": None, "cim_level": 1},
+    "fast": {"compress_type": zipfile39.ZIP_DEFLATED, "jar_level": 1, "cim_level": 1},
+    "balanced": {"compress_type": zipfile39.ZIP_DEFLATED, "jar_level": 6, "cim_level": 6},
+    "small": {"compress_type": zipfile39.ZIP_DEFLATED, "jar_level": 9, "cim_level": 9},
+}
+DEFAULT_OUTPUT_PROFILE = "fast"
+
+# Layout of a zip local file header, see APPNOTE.TXT section 4.3.7
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+_LOCAL_HEADER_FORMAT = "<4s2B4HL2L2H"
+_LOCAL_HEADER_SIZE = struct.calcsize(_LOCAL_HEADER_FORMAT)
+_LOCAL_HEADER_FLAGS_OFFSET = 6
+_LOCAL_HEADER_CRC_OFFSET = 14
+_DATA_DESCRIPTOR_FLAG = 0x08
+_ZIP64_LIMIT = (1 << 31) - 1
+
+
+def output_profile(name=None):
+    """Return the compression settings `name`, by default from MODLOADER_OUTPUT_PROFILE"""
+
+    if name is None:
+        name = settings.env_choice("MODLOADER_OUTPUT_PROFILE", OUTPUT_PROFILES, DEFAULT_OUTPUT_PROFILE)
+    if name not in OUTPUT_PROFILES:
+        ui.log.log("  ERROR: Unknown output profile '{}', expected one of {}".format(name, ", ".join(OUTPUT_PROFILES)))
+        name = DEFAULT_OUTPUT_PROFILE
+    return OUTPUT_PROFILES[name]
+
+
+class VanillaLibrary:
+    """Read access to the library files of spacehaven.jar
+
+    With a `cachePath`, files are decompressed there the first time they are needed and
+    read back from it afterwards. Without one they are decompressed straight from the jar.
+    Listing the files only ever reads the jar central directory. The XML files parsed
+    with `parse` are also kept in the cache as snapshots, quicker to parse again.
+    """
+
+    def __init__(self, jarPath, cachePath=None):
+        self.jarPath = jarPath
+        self.cachePath = cachePath
+        self.jar = zipfile39.ZipFile(jarPath, "r")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.jar.close()
+
+    def namelist(self):
+        """List the library files, from the jar central directory"""
+        return [file for file in self.jar.namelist() if file.startswith("library/") and not file.endswith("/")]
+
+    def extract(self, filenames):
+        """Decompress `filenames` into the cache, unless they already are"""
+
+        if not self.cachePath:
+            return
+
+        for filename in filenames:
+            path = self._cached_path(filename)
+            if os.path.isfile(path):
+                continue
+
+            ui.log.log("  Extracting {} to {}...".format(filename, self.cachePath))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with loader.clone.atomic_write(path) as partial, self.jar.open(filename) as source, open(partial, "wb") as target:
+                shutil.copyfileobj(source, target, COPY_CHUNK_SIZE)
+
+    def read(self, filename):
+        if not self.cachePath:
+            return self.jar.read(filename)
+
+        self.extract([filename])
+        with open(self._cached_path(filename), "rb") as f:
+            return f.read()
+
+    def parse(self, filename):
+        """Parse the XML file `filename`, dropping the whitespace between elements
+
+        With a cache, the parsed file is saved there as a snapshot: UTF-8 without that whitespace,
+        which is what later builds parse instead, unless `keep_warm` already parsed it again
+        in memory. The time it took is logged either way.
+        """
+
+        start = time.perf_counter()
+        snapshotPath = self._snapshot_path(filename)
+        tree = None
+        if snapshotPath:
+            tree = warm.TREES.take(self._snapshot_dir(), filename)
+            source = "memory"
+        if tree is None and snapshotPath and os.path.isfile(snapshotPath):
+            try:
+                tree = _parse_snapshot(snapshotPath)
+                source = "snapshot"
+            except lxml.etree.XMLSyntaxError as e:
+                ui.log.log("  ERROR: Invalid snapshot {}, parsing {} again: {}".format(snapshotPath, filename, e))
+
+        if tree is None:
+            tree = lxml.etree.parse(io.BytesIO(self.read(filename)), parser=create_xml_parser(remove_blank_text=True))
+            source = "game files"
+            if snapshotPath:
+                os.makedirs(os.path.dirname(snapshotPath), exist_ok=True)
+                with loader.clone.atomic_write(snapshotPath) as partial:
+                    tree.write(partial, encoding="UTF-8", xml_declaration=True)
+
+        ui.log.log("  Parsed {} in {:.3f}s from {}".format(filename, time.perf_counter() - start, source))
+        return tree
+
+    def keep_warm(self, filenames):
+        """Parse the snapshots of `filenames` again in the background, for the next build of the process
+
+        See `warm`, only does something with a cache. Only the snapshots are read, the library can be closed.
+        """
+
+        if self.cachePath:
+            parsers = {filename: functools.partial(_parse_snapshot, self._snapshot_path(filename)) for filename in filenames}
+            warm.TREES.refill(self._snapshot_dir(), parsers)
+
+    def _cached_path(self, filename):
+        return os.path.join(self.cachePath, filename.replace("/", os.sep))
+
+    def _snapshot_dir(self):
+        # the encoding the files are parsed with is baked into the snapshots
+        encoding = os.environ.get("FORCE_PARSER_ENCODING") or "auto"
+        return os.path.abspath(os.path.join(self.cachePath, "snapshots-{}-{}".format(SNAPSHOT_FORMAT, encoding)))
+
+    def _snapshot_path(self, filename):
+        if not self.cachePath:
+            return None
+        return os.path.join(self._snapshot_dir(), filename.replace("/", os.sep))
+
+
+def _parse_snapshot(path):
+    with open(path, "rb") as f:
+        return lxml.etree.parse(f, parser=lxml.etree.XMLParser(remove_blank_text=True))
+
 
 def extract(jarPath, corePath):
     """Extract library files from spacehaven.jar"""
@@ -28,8 +201,128 @@ def extract(jarPath, corePath):
                 spacehaven.extract(file, corePath)
 
 
-def patch(jarPath, corePath, resultPath, extra_assets=None):
-    """Patch spacehaven.jar with custom library files"""
+def _copy_raw(original, patched, info):
+    """Append the entry `info` of `original` to `patched` without decompressing it"""
+
+    if info.file_size >= _ZIP64_LIMIT or info.compress_size >= _ZIP64_LIMIT:
+        # not worth handling zip64 headers here, let zipfile deal with them
+        return _copy_streamed(original, patched, info)
+
+    original.fp.seek(info.header_offset)
+    header = bytearray(original.fp.read(_LOCAL_HEADER_SIZE))
+    fields = struct.unpack(_LOCAL_HEADER_FORMAT, header)
+    if fields[0] != _LOCAL_HEADER_SIGNATURE:
+        raise zipfile39.BadZipFile("Bad magic number for file header")
+    header += original.fp.read(fields[-2] + fields[-1])
+
+    zinfo = copy.copy(info)
+    if zinfo.flag_bits & _DATA_DESCRIPTOR_FLAG:
+        # sizes and crc live in a data descriptor after the data, move them into the header
+        zinfo.flag_bits &= ~_DATA_DESCRIPTOR_FLAG
+        struct.pack_into("<H", header, _LOCAL_HEADER_FLAGS_OFFSET, zinfo.flag_bits)
+        struct.pack_into("<3L", header, _LOCAL_HEADER_CRC_OFFSET, zinfo.CRC, zinfo.compress_size, zinfo.file_size)
+
+    def _chunks():
+        remaining = zinfo.compress_size
+        while remaining > 0:
+            chunk = original.fp.read(min(COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise zipfile39.BadZipFile("Truncated data for {}".format(zinfo.filename))
+            remaining -= len(chunk)
+            yield chunk
+
+    _append_raw(patched, zinfo, header, _chunks())
+
+
+def _append_raw(patched, zinfo, header, chunks):
+    """Append an entry to `patched` from its local header and its already compressed data"""
+
+    with patched._lock:
+        patched._writecheck(zinfo)
+        patched.fp.seek(patched.start_dir)
+        zinfo.header_offset = patched.fp.tell()
+        patched.fp.write(header)
+        for chunk in chunks:
+            patched.fp.write(chunk)
+
+        patched.start_dir = patched.fp.tell()
+        patched.filelist.append(zinfo)
+        patched.NameToInfo[zinfo.filename] = zinfo
+        patched._didModify = True
+
+
+def _copy_streamed(original, patched, info):
+    """Append the entry `info` of `original` to `patched`, recompressing it chunk by chunk"""
+
+    zinfo = zipfile39.ZipInfo(info.filename, date_time=info.date_time)
+    zinfo.compress_type = patched.compression
+    zinfo.external_attr = info.external_attr
+    zinfo.file_size = info.file_size
+    with original.open(info) as src, patched.open(zinfo, "w") as dst:
+        shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+
+
+def _deflate_block(data, start, level):
+    """Deflate one block of `data` into a piece of a raw deflate stream
+
+    Blocks are primed with the window preceding them and all but the last end on a byte
+    boundary, so the compressed blocks can simply be concatenated (the pigz approach).
+    """
+    view = memoryview(data)
+    end = start + DEFLATE_BLOCK_SIZE
+    if start:
+        window = max(0, start - _DEFLATE_WINDOW_SIZE)
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=view[window:start])
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    flush_mode = zlib.Z_FINISH if end >= len(data) else zlib.Z_SYNC_FLUSH
+    return compressor.compress(view[start:end]) + compressor.flush(flush_mode)
+
+
+def _schedule_modded(executor, file, contents, date_time, profile):
+    """Start compressing a modded entry in `executor`"""
+
+    if isinstance(contents, str):
+        with open(contents, "rb") as f:
+            contents = f.read()
+
+    zinfo = zipfile39.ZipInfo(file, date_time=date_time)
+    zinfo.external_attr = 0o644 << 16
+    zinfo.file_size = len(contents)
+    crc = executor.submit(zlib.crc32, contents)
+
+    if file.endswith(STORED_EXTENSIONS) or profile["compress_type"] == zipfile39.ZIP_STORED:
+        zinfo.compress_type = zipfile39.ZIP_STORED
+        blocks = None
+    else:
+        zinfo.compress_type = zipfile39.ZIP_DEFLATED
+        level = profile["jar_level"]
+        blocks = [executor.submit(_deflate_block, contents, start, level) for start in range(0, max(len(contents), 1), DEFLATE_BLOCK_SIZE)]
+
+    return zinfo, contents, crc, blocks
+
+
+def _append_modded(patched, zinfo, contents, crc, blocks):
+    """Append a modded entry scheduled with `_schedule_modded` once its compression is done"""
+
+    chunks = [contents] if blocks is None else [block.result() for block in blocks]
+    zinfo.CRC = crc.result()
+    zinfo.compress_size = sum(len(chunk) for chunk in chunks)
+    _append_raw(patched, zinfo, zinfo.FileHeader(), chunks)
+
+
+def patch(jarPath, resultPath, modded, passthrough=True, workers=None, profile=None):
+    """Patch spacehaven.jar with custom library files
+
+    `modded` maps jar entry names to their new contents, either as bytes or as the path of a
+    file to copy. With `passthrough` the vanilla entries are copied as-is (compressed bytes and
+    local header), only the modded entries are compressed again.
+
+    Modded entries are compressed according to the `output_profile` `profile` on `workers`
+    threads (all cores by default) and appended in the order of `modded`.
+    """
+    if profile is None:
+        profile = output_profile()
 
     ui.log.log("Patch spacehaven.jar with custom library files...")
 
@@ -38,11 +331,14 @@ def patch(jarPath, corePath, resultPath, extra_assets=None):
 
     ui.log.updateBackgroundState("Merging vanilla files")
 
-    update_files = PATCHABLE_XML_FILES + PATCHABLE_CIM_FILES
-    for file in set(original.namelist()):
-        if not file.endswith("/") and file not in update_files:
+    copy_entry = _copy_raw if passthrough else _copy_streamed
+    skip_files = set(modded)
+    for info in original.infolist():
+        file = info.filename
+        if not file.endswith("/") and file not in skip_files:
+            skip_files.add(file)
             try:
-                patched.writestr(file, original.read(file))
+                copy_entry(original, patched, info)
             except Exception as e:
                 ui.log.log("ERROR: Unable to add {} to {}: {}".format(str(file), str(resultPath), str(e)))
                 pass
@@ -50,11 +346,28 @@ def patch(jarPath, corePath, resultPath, extra_assets=None):
     original.close()
 
     ui.log.updateBackgroundState("Merging modded files")
-
-    if extra_assets:
-        update_files += extra_assets
-    for file in update_files:
-        ui.log.log("  Merging modded {}...".format(file))
-        patched.write(os.path.join(corePath, file.replace("/", os.sep)), file)
+    _write_modded(patched, modded, workers, profile)
 
     patched.close()
+
+
+def overlay(resultPath, modded, workers=None, profile=None):
+    """Write only the modded library files to a jar meant to shadow spacehaven.jar on the classpath"""
+    if profile is None:
+        profile = output_profile()
+
+    ui.log.log("Write overlay jar with custom library files...")
+    ui.log.updateBackgroundState("Merging modded files")
+
+    with zipfile39.ZipFile(resultPath, "w") as patched:
+        _write_modded(patched, modded, workers, profile)
+
+
+def _write_modded(patched, modded, workers, profile):
+    date_time = time.localtime(time.time())[:6]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        # zlib releases the GIL, compress everything at once then write in a deterministic order
+        scheduled = [_schedule_modded(executor, file, contents, date_time, profile) for file, contents in modded.items()]
+        for entry in scheduled:
+            ui.log.log("  Merging modded {}...".format(entry[0].filename))
+            _append_modded(patched, *entry)
@@ -1,17 +1,17 @@
+import concurrent.futures
 import copy
 import os
 from pathlib import Path
-import shutil
 
 import lxml.etree
-import png
-import rectpack
-import ui.database
 import ui.log
+from loader import settings
 
+from . import atlas, pngcodec
 from .explode import Texture
-from .library import PATCHABLE_CIM_FILES, PATCHABLE_XML_FILES
+from .library import PATCHABLE_CIM_FILES, PATCHABLE_XML_FILES, VanillaLibrary, output_profile
 from .patch import doPatches
+from .texturemanager import TextureManager
 from .utils import create_xml_parser
 
 
@@ -121,81 +121,10 @@ def _detect_textures(coreLibrary, modLibrary, mod):
             new_id = mapping_n_region[mod_local_id]
             asset.set("a", new_id)
 
-    if len(needs_autogeneration):
-        # image_count = len(needs_autogeneration)
-
-        regionsNode = textures_mod.find(".//regions")
-        texturesNode = textures_mod.find(".//textures")
-
-        textureID: int = ui.database.ModDatabase.getMod(mod).prefix
-
-        # Catch missing Modder ID.  Still try to process and move forward.
-        if not textureID or textureID <= 0:
-            ui.log.log("ERROR: info.xml is missing <modid>.  Mod Author should set this to their Discord ID for all mods they make.")
-            textureID = 9999
-
-        packer = rectpack.newPacker(rotation=False)
-
-        # Sprite sheets MUST be 2048 x 2048
-        standard_dimension: int = 2048
-        str_dimension: str = str(standard_dimension)
-        packer.add_bin(standard_dimension, standard_dimension)
-
-        # First get all the files and them to the packer pack them into a new texture square
-        for regionName in needs_autogeneration:
-            (w, h, rows, info) = png.Reader(textures_path + "/" + regionName).asRGBA()
-            packer.add_rect(w, h, regionName)
-
-        # Pack files and check that we packed everything
-        packer.pack()
-        rectangles_packed: int = sum(len(packer_bin) for packer_bin in packer)
-        if rectangles_packed < len(needs_autogeneration):
-            # TODO handle case when we can't pack all the textures into one bin instead of raising an Exception
-            raise Exception(
-                f"Mod '{os.path.basename(mod)}' exceeds available sprite sheet space. Contact Mod Author." " Mod Authors should spread the sprites into multiple mods to work around this limitation."
-            )
-
-        newTex = lxml.etree.SubElement(texturesNode, "t")
-        newTex.set("i", str(textureID))
-        newTex.set("w", str_dimension)
-        newTex.set("h", str_dimension)
-        coreLibrary["_custom_textures_cim"][str(textureID)] = newTex.attrib
-
-        # prepare to export packed PNG to mod directory.
-        kwargs = {
-            "create": True,
-            "width": standard_dimension,
-            "height": standard_dimension,
-        }
-        export_path = os.path.join(mod, f"custom_texture_{textureID}.png")
-        custom_png: Texture = Texture(export_path, **kwargs)
-
-        packedRectsSorted = {}
-        for rect in packer.rect_list():
-            b, x, y, w, h, rid = rect
-            remappedID = mapping_n_region[rid]
-            packedRectsSorted[remappedID] = (str(x), str(y), str(w), str(h), str(rid))
-            custom_png.pack_png(os.path.join(textures_path, rid), x, y, w, h)
-
-        # write back the cim file as png for debugging
-        # this only includes textures from this mod, not the final generated cim.
-        custom_png.export_png(export_path)
-
-        # NOT YET SORTED
-        packedRectsSorted = {k: v for k, v in sorted(packedRectsSorted.items())}
-        # NOW SORTED: We need this to make sure the IDs are added to the textures file in the correct order
-
-        for remappedID, data in packedRectsSorted.items():
-            x, y, w, h, regionFileName = data
-            # remapData = modded_textures[remappedID]
-            newNode = lxml.etree.SubElement(regionsNode, "re")
-            newNode.set("n", remappedID)
-            newNode.set("t", str(textureID))
-            newNode.set("x", x)
-            newNode.set("y", y)
-            newNode.set("w", w)
-            newNode.set("h", h)
-            newNode.set("file", regionFileName)
+    # packed together with the textures of the other mods once they are all loaded, see `_pack_textures`
+    for regionName in sorted(needs_autogeneration):
+        if regionName in mapping_n_region:
+            coreLibrary["_texture_manager"].registerNewTexture(mod, regionName, int(mapping_n_region[regionName]))
 
     for asset in textures_mod.xpath("//re[@n]"):
         mod_local_id = asset.get("n")
@@ -205,57 +134,183 @@ def _detect_textures(coreLibrary, modLibrary, mod):
         ui.log.log("  Mapping texture 're' {} to {}...".format(mod_local_id, new_id))
         asset.set("n", new_id)
 
-    # write the new textures XML if changed.
+    # the new textures XML is written once the textures are packed,
+    # from a copy since merging moves the mod elements into the core library
     if autoAnimations:
-        modLibrary["library/textures"][0].write(os.path.join(mod, "library", "generated_textures.xml"), pretty_print=True)
+        coreLibrary["_generated_textures"][mod] = copy.deepcopy(textures_mod)
 
     return modded_textures
 
 
-def buildLibrary(location: str, mod: str):
-    """Build up a library dict of files in `location`"""
+def _pack_textures(coreLibrary):
+    """Pack the textures of all the mods into new texture pages, added to the core library"""
+
+    manager = coreLibrary["_texture_manager"]
+    if manager.REGISTERED_MOD_TEXTURES:
+        _add_packed_pages(coreLibrary, manager)
+
+    # keep a copy of the textures XML of each mod with its packed textures, for mod authors
+    for mod, textures_mod in coreLibrary["_generated_textures"].items():
+        modPacked = manager.getXMLTexture(mod)
+        textures_mod.find(".//textures").extend(list(modPacked.find(".//textures")))
+        textures_mod.find(".//regions").extend(list(modPacked.find(".//regions")))
+
+        generated = lxml.etree.tostring(textures_mod, pretty_print=True)
+        generated_path = os.path.join(mod, "library", "generated_textures.xml")
+        try:
+            with open(generated_path, "rb") as f:
+                unchanged = f.read() == generated
+        except FileNotFoundError:
+            unchanged = False
+        if not unchanged:
+            with open(generated_path, "wb") as f:
+                f.write(generated)
+
+
+def _add_packed_pages(coreLibrary, manager):
+    """Pack or reuse the pages of `manager` and add them and their regions to the core textures"""
+
+    # the new pages come after all the pages of the game and of the mods
+    coreTextures = coreLibrary["library/textures"]
+    used = [int(i) for i in coreTextures.xpath("//t/@i") + list(coreLibrary["_custom_textures_cim"]) if str(i).isdecimal()]
+    manager.FirstTextureID = max([manager.CustomTextureIDStart] + [i + 1 for i in used])
+
+    # the packing only depends on the texture files, reuse it until one of them changes
+    key = atlas.content_key(manager.getFiles(), manager.getParameters())
+    cached = atlas.load(key)
+    if cached is not None:
+        (layout, pages) = cached
+        manager.setLayout(layout)
+    else:
+        manager.pack()
+        pages = manager.composite(images=coreLibrary["_decoded_images"])
+        atlas.store(key, manager.getLayout(), pages)
+
+    packed = manager.getXMLTexture()
+    for newTex in packed.xpath("//t[@i]"):
+        coreLibrary["_custom_textures_cim"][newTex.get("i")] = newTex.attrib
+        coreLibrary["_packed_sheets"][newTex.get("i")] = (pages[int(newTex.get("i")) - manager.FirstTextureID], set())
+    coreTextures.find(".//textures").extend(list(packed.find(".//textures")))
+
+    for region in packed.xpath("//re[@n]"):
+        (sheet, sheet_regions) = coreLibrary["_packed_sheets"][region.get("t")]
+        sheet_regions.add(region.get("n"))
+        # the packed page is the starting point of its cim page, see `mods`
+        rect = tuple(int(region.get(k)) for k in ("x", "y", "w", "h"))
+        coreLibrary["_all_modded_textures"][region.get("n")]["sheet"] = (sheet, *rect)
+    coreTextures.find(".//regions").extend(list(packed.find(".//regions")))
+
+
+def _build_page(vanilla, coreLibrary, page, regions, level):
+    """Copy the modded textures of `regions` into a cim page, returns the compressed page"""
+
+    cim_name = "library/{}.cim".format(page)
+    kwargs = {"create": False}
+    # TODO better cross checking of texture packs
+    if cim_name not in PATCHABLE_CIM_FILES:
+        kwargs["create"] = True
+        kwargs["width"] = coreLibrary["_custom_textures_cim"][page]["w"]
+        kwargs["height"] = coreLibrary["_custom_textures_cim"][page]["h"]
+    else:
+        kwargs["data"] = vanilla.read(cim_name)
+
+    # start from the packed sheet of the page as long as all of its textures are still used
+    (sheet, sheet_regions) = coreLibrary["_packed_sheets"].get(page, (None, ()))
+    if kwargs["create"] and sheet is not None and all(_packed_in(coreLibrary["_all_modded_textures"].get(n), sheet) for n in sheet_regions):
+        texture = sheet
+    else:
+        texture = Texture(cim_name, **kwargs)
+
+    for modded_texture, (x, y, w, h) in regions:
+        if modded_texture.get("sheet") == (texture, x, y, w, h):
+            continue
+
+        ui.log.log("  Patching {}.cim...".format(page))
+        texture.pack_png(modded_texture["path"], x, y, w, h, images=coreLibrary["_decoded_images"])
+
+    ui.log.log("  Writing {}.cim...".format(page))
+    return texture.export_cim_bytes(cim_name, level)
+
+
+def _packed_in(texture, sheet):
+    """Whether a modded texture still comes from the packed `sheet`"""
+    return texture is not None and texture.get("sheet", (None,))[0] is sheet
+
+
+def _library_files(location: str, mod: str):
+    """(target, mod file, path) of the xml files of `mod` in `location`, in the order they are loaded"""
 
     def _mod_path(filename):
         return os.path.join(mod, filename.replace("/", os.sep))
 
-    location_library = {}
     try:
         location_files = [location + "/" + mod_file for mod_file in os.listdir(_mod_path(location))]
     except FileNotFoundError:
         location_files = []
 
     # we allow breaking down mod xml files into smaller pieces for readability
+    files = []
     for target in PATCHABLE_XML_FILES:
         targetInLocation = target.replace("library", location)
         for mod_file in location_files:
-            if not mod_file.startswith(targetInLocation):
-                continue
-            if target not in location_library:
-                location_library[target] = []
-
-            ui.log.log("    {} <= {}".format(target, mod_file))
-            with open(_mod_path(mod_file), "rb") as f:
-                location_library[target].append(lxml.etree.parse(f, parser=create_xml_parser()))
-
-        mod_file = _mod_path(target)
-        # try again with the extension ?
-        if not os.path.exists(mod_file):
-            mod_file += ".xml"
-            if not os.path.exists(mod_file):
-                continue
+            if mod_file.startswith(targetInLocation):
+                files.append((target, mod_file, _mod_path(mod_file)))
+    return files
+
+
+def _parse_mod_file(path):
+    with open(path, "rb") as f:
+        return lxml.etree.parse(f, parser=create_xml_parser())
+
+
+def prefetchLibraries(libraries, workers=None):
+    """Start parsing the files of the (location, mod) `libraries` on a thread pool
+
+    Returns the parsed files to come by path, for `buildLibrary`. lxml doesn't hold the GIL while
+    parsing, so the files are parsed side by side, and in the background of the merge.
+    """
+
+    paths = [path for location, mod in libraries for target, mod_file, path in _library_files(location, mod)]
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(settings.workers("MODLOADER_PARSE_WORKERS", workers), max(len(paths), 1)))
+    prefetched = {path: executor.submit(_parse_mod_file, path) for path in paths}
+    # the queued files are still parsed, the threads exit once done
+    executor.shutdown(wait=False)
+    return prefetched
+
+
+def buildLibrary(location: str, mod: str, prefetched=None):
+    """Build up a library dict of files in `location`
+
+    Files already parsed by `prefetchLibraries` are taken from `prefetched`, the others are parsed here.
+    """
+
+    location_library = {}
+    for target, mod_file, path in _library_files(location, mod):
+        ui.log.log("    {} <= {}".format(target, mod_file))
+        future = prefetched.pop(path, None) if prefetched else None
+        location_library.setdefault(target, []).append(future.result() if future else _parse_mod_file(path))
     return location_library
 
 
-def mods(corePath, activeMods, modPaths):
+def mods(vanilla: VanillaLibrary, activeMods, modPaths, profile=None, workers=None):
+    """Merge and patch the mods into the core library.
+
+    Returns the modified library files as a dict of jar entry name to either the file
+    contents or the path of a mod file to copy as-is. Cim pages are compressed according
+    to the `output_profile` `profile`, on `workers` threads.
+    """
+    if profile is None:
+        profile = output_profile()
+    modded = {}
+
+    # the mod files are parsed while the core library is
+    prefetched = prefetchLibraries([("library", mod) for mod in modPaths] + [("patches", mod.path) for mod in activeMods])
+
     # Load the core library files
     coreLibrary = {}
 
-    def _core_path(filename):
-        return os.path.join(corePath, filename.replace("/", os.sep))
-
     for filename in PATCHABLE_XML_FILES:
-        with open(_core_path(filename), "rb") as f:
-            coreLibrary[filename] = lxml.etree.parse(f, parser=create_xml_parser())
+        coreLibrary[filename] = vanilla.parse(filename)
 
     # find the last region in the texture file and remember its index
     # we will need this to add mod textures with consecutive indexes...
@@ -263,6 +318,11 @@ def mods(corePath, activeMods, modPaths):
     coreLibrary["_next_region_id"] = coreLibrary["_last_core_region_id"] + 1
     coreLibrary["_all_modded_textures"] = {}
     coreLibrary["_custom_textures_cim"] = {}
+    # mod textures are packed into their own sheet first, then into the cim pages
+    coreLibrary["_decoded_images"] = pngcodec.DecodedImages()
+    coreLibrary["_packed_sheets"] = {}
+    coreLibrary["_texture_manager"] = TextureManager()
+    coreLibrary["_generated_textures"] = {}
 
     # Merge in modded files
     for mod in modPaths:
@@ -271,25 +331,23 @@ def mods(corePath, activeMods, modPaths):
         ui.log.log("  Loading mod {}...".format(mod))
 
         # Load the mod's library
-        modLibrary = buildLibrary("library", mod)
+        modLibrary = buildLibrary("library", mod, prefetched)
         doMerges(coreLibrary, modLibrary, mod)
 
+    _pack_textures(coreLibrary)
+
     # Do patches after merges to avoid clobbers
     for mod in activeMods:
         ui.log.updateLaunchState(f"Patching {os.path.basename(mod.path)}")
         ui.log.log(f"  Loading patches {mod.path}...")
-        modPatchesLibrary = buildLibrary("patches", mod.path)
+        modPatchesLibrary = buildLibrary("patches", mod.path, prefetched)
         doPatches(coreLibrary, modPatchesLibrary, mod)
 
     ui.log.updateLaunchState("Updating XML")
 
-    # Write out the new base library
+    # Serialize the new base library
     for filename in PATCHABLE_XML_FILES:
-        with open(_core_path(filename), "wb") as f:
-            f.write(lxml.etree.tostring(coreLibrary[filename], pretty_print=True, encoding="UTF-8"))
-
-    # EXTRA ASSETS ADDED BY MODS
-    extra_assets = []
+        modded[filename] = lxml.etree.tostring(coreLibrary[filename], pretty_print=True, encoding="UTF-8")
 
     # AUDIO
     ui.log.updateLaunchState("Packing audio")
@@ -305,12 +363,10 @@ def mods(corePath, activeMods, modPaths):
     # get the game's original audio file list
     original_audio_relative_paths = set()
     for valid_audio_type in valid_audio_types:
-        original_audio_directory = os.path.join(corePath, "library", valid_audio_type.lower())
-        for abs_dir, _, filenames in os.walk(original_audio_directory):
-            for filename in filenames:
-                rel_dir = os.path.relpath(abs_dir, corePath)
-                rel_path = os.path.join(rel_dir, filename)
-                original_audio_relative_paths.add(rel_path.replace(os.sep, "/"))
+        original_audio_directory = "library/" + valid_audio_type.lower() + "/"
+        for filename in vanilla.namelist():
+            if filename.startswith(original_audio_directory):
+                original_audio_relative_paths.add(filename)
 
     # process each audio entry in 'audio' file
     for audio in coreLibrary["library/audio"].xpath("//a[@n and @at]"):
@@ -366,56 +422,37 @@ def mods(corePath, activeMods, modPaths):
 
         # copy audio to library
         ui.log.log(f"  Copying {audio_relative_path}...")
-        audio_dst_path = os.path.join(corePath, "library", audio_type.lower(), audio_encoding, audio_filename)
-        shutil.copy(str(audio_src_path), audio_dst_path)
-        extra_assets.append(audio_relative_path)
+        modded[audio_relative_path] = str(audio_src_path)
 
     # TEXTURE
     ui.log.updateLaunchState("Packing textures")
     # add or overwrite textures from mods. This is done after all the XML has been merged into the core "textures" file
-    cims = {}
-    reexport_cims = {}
-
+    # the modded regions are grouped by cim page, every page is then built on its own
+    pages = {}
     for region in coreLibrary["library/textures"].xpath("//re[@n]"):
         name = region.get("n")
 
         if name not in coreLibrary["_all_modded_textures"]:
             continue
 
-        png_file = coreLibrary["_all_modded_textures"][name]["path"]
-
-        page = region.get("t")
-        if page not in cims:
-            cim_name = "{}.cim".format(page)
-            kwargs = {"create": False}
-            # TODO better cross checking of texture packs
-            if "library/" + cim_name not in PATCHABLE_CIM_FILES:
-                kwargs["create"] = True
-                kwargs["width"] = coreLibrary["_custom_textures_cim"][page]["w"]
-                kwargs["height"] = coreLibrary["_custom_textures_cim"][page]["h"]
-                extra_assets.append("library/" + cim_name)
-
-            cims[page] = Texture(os.path.join(corePath, "library", cim_name), **kwargs)
-
-            reexport_cims[page] = set()
-
-        # write back the cim file as png for debugging
-        # reexport_cims[page].add(os.path.normpath(mod + "/textures"))
+        rect = tuple(int(region.get(key)) for key in ("x", "y", "w", "h"))
+        pages.setdefault(region.get("t"), []).append((coreLibrary["_all_modded_textures"][name], rect))
 
-        x = int(region.get("x"))
-        y = int(region.get("y"))
-        w = int(region.get("w"))
-        h = int(region.get("h"))
+    # only the vanilla pages that modded textures land on are needed
+    vanilla.extract(cim_name for cim_name in PATCHABLE_CIM_FILES if cim_name in set("library/{}.cim".format(page) for page in pages))
 
-        ui.log.log("  Patching {}.cim...".format(page))
-        cims[page].pack_png(png_file, x, y, w, h)
+    workers = min(settings.workers("MODLOADER_TEXTURE_WORKERS", workers), max(len(pages), 1))
+    ui.log.log("  Writing {} cim pages on {} threads...".format(len(pages), workers))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        # NumPy, Pillow and zlib release the GIL, so pages are composited and compressed side by side
+        futures = {page: executor.submit(_build_page, vanilla, coreLibrary, page, regions, profile["cim_level"]) for page, regions in pages.items()}
+        # pages contains only the textures files that have actually been modified
+        for page, future in futures.items():
+            modded["library/{}.cim".format(page)] = future.result()
 
-    # cims contains only the textures files that have actually been modified
-    for page in cims:
-        ui.log.log("  Writing {}.cim...".format(page))
-        cims[page].export_cim(os.path.join(corePath, "library", "{}.cim".format(page)))
+    ui.log.log("  Decoded {} texture files".format(coreLibrary["_decoded_images"].decoded))
 
-    return extra_assets
+    return modded
 
 
 def doMerges(coreLib, modLib, mod: str):
@@ -521,13 +558,31 @@ def doMerges(coreLib, modLib, mod: str):
         mergeAbortMessage(currentFile)
 
 
+def _merge_index(baseLibrary, file, xpath, idAttribute):
+    """The section of the core library at `xpath` and its elements by id, built on first use
+
+    The index lives as long as the core library, `mergeDefinitions` keeps it up to date.
+    """
+    indexes = baseLibrary.setdefault("_merge_index", {})
+    key = (file, xpath, idAttribute)
+    if key not in indexes:
+        baseRoot = baseLibrary[file].xpath(xpath)[0]
+        index = {}
+        for element in baseRoot.iterchildren(tag=lxml.etree.Element):
+            elementID = element.get(idAttribute)
+            if elementID is not None:
+                index.setdefault(elementID, []).append(element)
+        indexes[key] = (baseRoot, index)
+    return indexes[key]
+
+
 def mergeDefinitions(baseLibrary, modLibrary, file, xpath, idAttribute):
     if file not in modLibrary:
         ui.log.log("    {}: Not present".format(file))
         return
 
     try:
-        baseRoot = baseLibrary[file].xpath(xpath)[0]
+        (baseRoot, index) = _merge_index(baseLibrary, file, xpath, idAttribute)
     except IndexError:
         # that's a big error if we can't find it in the core!
         ui.log.log("    {}: ERROR CORE NOTHING AT {}".format(file, xpath))
@@ -547,12 +602,14 @@ def mergeDefinitions(baseLibrary, modLibrary, file, xpath, idAttribute):
 
             # TODO auto-id algo: if element.get(idAttribute + "_auto") then
             # id = prefix * idSpaceSize + id
-            conflicts = baseRoot.xpath("*[@{}='{}']".format(idAttribute, element.get(idAttribute)))
-
-            for conflict in conflicts:
+            elementID = element.get(idAttribute)
+            for conflict in index.pop(elementID, ()):
                 baseRoot.remove(conflict)
 
-            baseRoot.append(copy.deepcopy(element))
+            # the mod library is discarded after the merge, its elements are moved rather than copied
+            baseRoot.append(element)
+            if elementID is not None:
+                index[elementID] = [element]
             merged += 1
 
         if merged:
@@ -94,6 +94,21 @@ def AttributeMath(patchArgs):
             element.set(attribute, f"{newVal}")
 
 
+def _valueNodes(nodes, matchingElements):
+    """Pair each matching element with the `nodes` to insert there
+
+    The patch files are discarded after the build, so the last match takes the nodes themselves
+    and only the other matches get copies of them.
+    """
+    nodes = list(nodes)
+    last = len(matchingElements) - 1
+    for index, element in enumerate(matchingElements):
+        if index == last:
+            yield element, nodes
+        else:
+            yield element, [copy.deepcopy(node) for node in nodes]
+
+
 def NodeAdd(patchArgs):
     """Adds the provided node(s) as last child to the selected node"""
     parent: lxml.etree._Element
@@ -103,11 +118,11 @@ def NodeAdd(patchArgs):
     if value is None:
         raise SyntaxError("Invalid patch operation, <value> is not defined.")
 
-    for parent in matchingElements:
+    for parent, nodes in _valueNodes(value, matchingElements):
         index = len(parent.getchildren())
-        for node in value:
+        for node in nodes:
             index += 1
-            parent.insert(index, copy.deepcopy(node))
+            parent.insert(index, node)
 
 
 def NodeAddFirst(patchArgs):
@@ -119,9 +134,9 @@ def NodeAddFirst(patchArgs):
     if value is None:
         raise SyntaxError("Invalid patch operation, <value> is not defined.")
 
-    for parent in matchingElements:
-        for node in reversed(value):
-            parent.insert(1, copy.deepcopy(node))
+    for parent, nodes in _valueNodes(value, matchingElements):
+        for node in reversed(nodes):
+            parent.insert(1, node)
 
 
 def NodeInsert(patchArgs):
@@ -133,12 +148,12 @@ def NodeInsert(patchArgs):
     if value is None:
         raise SyntaxError("Invalid patch operation, <value> is not defined.")
 
-    for sibling in matchingElements:
+    for sibling, nodes in _valueNodes(value, matchingElements):
         parent = sibling.find("./..")
         index = parent.index(sibling)
-        for node in value:
+        for node in nodes:
             index += 1
-            parent.insert(index, copy.deepcopy(node))
+            parent.insert(index, node)
 
 
 def NodeInsertBefore(patchArgs):
@@ -150,11 +165,11 @@ def NodeInsertBefore(patchArgs):
     if value is None:
         raise SyntaxError("Invalid patch operation, <value> is not defined.")
 
-    for sibling in matchingElements:
+    for sibling, nodes in _valueNodes(value, matchingElements):
         parent = sibling.find("./..")
         index = parent.index(sibling)
-        for node in reversed(value):
-            parent.insert(index, copy.deepcopy(node))
+        for node in reversed(nodes):
+            parent.insert(index, node)
 
 
 def NodeRemove(patchArgs):
@@ -178,9 +193,9 @@ def NodeReplace(patchArgs):
     if len(value.getchildren()) <= 0:
         raise SyntaxError("Invalid patch operation, <value> must contain a node.")
 
-    for target in matchingElements:
+    for target, nodes in _valueNodes(value[:1], matchingElements):
         parent = target.find("./..")
-        parent.replace(target, copy.deepcopy(value[0]))
+        parent.replace(target, nodes[0])
 
 
 # Default case function
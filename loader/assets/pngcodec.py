@@ -0,0 +1,141 @@
+"""Read and write RGBA png files, with Pillow when it is installed and pypng otherwise"""
+
+import collections
+import os
+import struct
+import threading
+
+import png
+import ui.log
+from loader import settings
+
+try:
+    import PIL.Image
+except ImportError:
+    PIL = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BACKENDS = ("pillow", "pypng")
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Memory kept by DecodedImages, override with MODLOADER_IMAGE_CACHE_MB
+DEFAULT_IMAGE_CACHE_MB = 256
+
+
+def _default_backend():
+    """Pillow if available, MODLOADER_PNG_BACKEND can force pypng"""
+
+    name = settings.env_choice("MODLOADER_PNG_BACKEND", BACKENDS, None)
+    if name is None:
+        return "pillow" if PIL is not None else "pypng"
+
+    if name == "pillow" and PIL is None:
+        ui.log.log("  ERROR: Pillow is not installed, using pypng for png files")
+        name = "pypng"
+    return name
+
+
+DEFAULT_BACKEND = _default_backend()
+
+
+def read_rgba(path, backend=None):
+    """Decode a png file to 8 bit RGBA, returns (width, height, data) with the rows packed in `data`"""
+
+    if (backend or DEFAULT_BACKEND) == "pillow":
+        with PIL.Image.open(path) as image:
+            if image.mode != "RGBA":
+                image = image.convert("RGBA")
+            return image.width, image.height, image.tobytes()
+
+    (width, height, rows, info) = png.Reader(filename=path).asRGBA8()
+    return width, height, b"".join(rows)
+
+
+def write_rgba(path, width, height, rows, level=None, backend=None):
+    """Encode 8 bit RGBA `rows` (buffers of width * 4 bytes) to a png file
+
+    `rows` can also be a 2D NumPy view into a larger image, which isn't copied beforehand.
+    `level` is the zlib compression level, from 0 (fastest) to 9 (smallest), default 6.
+    """
+
+    if (backend or DEFAULT_BACKEND) == "pillow":
+        image = _pillow_image(width, height, rows)
+        image.save(path, format="PNG", compress_level=6 if level is None else level)
+        return
+
+    with open(path, "wb") as file:
+        writer = png.Writer(width=width, height=height, greyscale=False, alpha=True, compression=level)
+        writer.write_packed(file, rows)
+
+
+def _pillow_image(width, height, rows):
+    """Pillow image of the `rows`, reading NumPy views through their row stride rather than joining them"""
+
+    if numpy is None or not isinstance(rows, numpy.ndarray) or rows.dtype != numpy.uint8 or rows.strides[1] != 1 or not width or not height:
+        data = b"".join(rows)
+        return PIL.Image.frombuffer("RGBA", (width, height), data, "raw", "RGBA", 0, 1)
+
+    # a flat view from the first pixel of the region to its last one
+    stride = rows.strides[0]
+    span = numpy.lib.stride_tricks.as_strided(rows, shape=((height - 1) * stride + width * 4,), strides=(1,))
+    if stride == width * 4:
+        # whole rows, the image uses the memory of the view as is
+        return PIL.Image.frombuffer("RGBA", (width, height), span, "raw", "RGBA", 0, 1)
+    # the only copy is the one Pillow makes into the image
+    return PIL.Image.frombytes("RGBA", (width, height), span, "raw", "RGBA", stride, 1)
+
+
+def size(path):
+    """Width and height of a png file, read from its IHDR chunk without decoding the image"""
+
+    with open(path, "rb") as f:
+        header = f.read(24)
+    if header[:8] == PNG_SIGNATURE and header[12:16] == b"IHDR":
+        return struct.unpack(">II", header[16:24])
+
+    # not a png, let the decoder report the problem
+    (width, height, data) = read_rgba(path)
+    return width, height
+
+
+class DecodedImages:
+    """Decoded png files of a build, so that each one is decoded once
+
+    The least recently used images are dropped once they take more than `budget` bytes.
+    Safe to share between threads, files are decoded outside of the lock.
+    """
+
+    def __init__(self, budget=None):
+        if budget is None:
+            budget = settings.env_int("MODLOADER_IMAGE_CACHE_MB", DEFAULT_IMAGE_CACHE_MB, minimum=0) * 1024 * 1024
+        self.budget = budget
+        self.used = 0
+        self.decoded = 0
+        self._images = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def read_rgba(self, path):
+        """Same as `read_rgba`, from memory when the file was already decoded"""
+
+        key = os.path.abspath(path)
+        with self._lock:
+            if key in self._images:
+                self._images.move_to_end(key)
+                return self._images[key]
+
+        image = read_rgba(path)
+
+        with self._lock:
+            self.decoded += 1
+            if key not in self._images:
+                self._images[key] = image
+                self.used += len(image[2])
+            while self.used > self.budget:
+                (_, (width, height, data)) = self._images.popitem(last=False)
+                self.used -= len(data)
+        return image
@@ -0,0 +1,229 @@
+"""Pack the auto-packed textures of all the mods into as few texture pages as possible"""
+
+import os
+import sys
+
+import lxml.etree
+import rectpack
+import ui.log
+
+from loader import settings
+
+from . import pngcodec
+from .explode import Texture
+
+# Placement heuristics of rectpack, override with MODLOADER_PACK_ALGORITHM
+PACK_ALGORITHMS = {
+    name: getattr(rectpack, name)
+    for name in (
+        "MaxRectsBssf",
+        "MaxRectsBaf",
+        "MaxRectsBlsf",
+        "MaxRectsBl",
+        "SkylineBl",
+        "SkylineBlWm",
+        "SkylineMwf",
+        "SkylineMwfl",
+        "SkylineMwfWm",
+        "SkylineMwflWm",
+        "GuillotineBssfSas",
+        "GuillotineBafSas",
+        "GuillotineBlsfSas",
+    )
+}
+DEFAULT_PACK_ALGORITHM = "GuillotineBssfSas"
+
+# Order the textures are packed in, override with MODLOADER_PACK_SORT.
+# `global` fills one page at a time, always picking the texture that fits best: slower, but tighter.
+PACK_SORTS = {
+    "area": rectpack.SORT_AREA,
+    "perimeter": rectpack.SORT_PERI,
+    "difference": rectpack.SORT_DIFF,
+    "short-side": rectpack.SORT_SSIDE,
+    "long-side": rectpack.SORT_LSIDE,
+    "ratio": rectpack.SORT_RATIO,
+    "none": rectpack.SORT_NONE,
+    "global": None,
+}
+DEFAULT_PACK_SORT = "perimeter"
+
+
+def pack_algorithm():
+    return settings.env_choice("MODLOADER_PACK_ALGORITHM", PACK_ALGORITHMS, DEFAULT_PACK_ALGORITHM)
+
+
+def pack_sort():
+    return settings.env_choice("MODLOADER_PACK_SORT", PACK_SORTS, DEFAULT_PACK_SORT)
+
+
+class TextureManager:
+    """Textures of every mod, packed together into 2048 x 2048 pages"""
+
+    _TexFileResolution = 2048
+
+    # first page id, after the ones used by the game and by the mods
+    CustomTextureIDStart = 400
+
+    def __init__(self, algorithm=None, sort=None):
+        self.REGISTERED_MOD_TEXTURES = []
+        self.REGISTERED_MOD_PATHS = dict()
+        self.Algorithm = algorithm or pack_algorithm()
+        self.Sort = sort or pack_sort()
+        self.FirstTextureID = self.CustomTextureIDStart
+
+        # index in REGISTERED_MOD_TEXTURES => (bin, x, y, w, h)
+        self.Placements = {}
+
+    def registerNewTexture(self, mod: str, texPath: str, regionID: int):
+        tmp = RegisteredTexture(self, mod, texPath, regionID)
+        self.REGISTERED_MOD_TEXTURES.append(tmp)
+        return tmp
+
+    def getModTexturePath(self, mod: str, texPath: str):
+        if mod not in self.REGISTERED_MOD_PATHS:
+            texFolderPath = os.path.join(mod, "textures")
+            if os.path.exists(texFolderPath):
+                self.REGISTERED_MOD_PATHS[mod] = texFolderPath
+            else:
+                raise FileNotFoundError(f"Couldn't find {texFolderPath}")
+        return os.path.join(self.REGISTERED_MOD_PATHS[mod], texPath)
+
+    def getFiles(self):
+        """(name, path) of every texture, names are what layouts refer to"""
+        return [(rt.getName(), self.getModTexturePath(rt.ParentMod, rt.TexPath)) for rt in self.REGISTERED_MOD_TEXTURES]
+
+    def getParameters(self):
+        """Everything besides the textures that the packing depends on"""
+        return (self._TexFileResolution, self.Algorithm, self.Sort)
+
+    def pack(self):
+        algorithm = PACK_ALGORITHMS[self.Algorithm]
+        if self.Sort == "global":
+            packer = rectpack.newPacker(bin_algo=rectpack.PackingBin.Global, pack_algo=algorithm, rotation=False)
+        else:
+            packer = rectpack.newPacker(bin_algo=rectpack.PackingBin.BBF, pack_algo=algorithm, sort_algo=PACK_SORTS[self.Sort], rotation=False)
+
+        # as many bins as needed
+        packer.add_bin(self._TexFileResolution, self._TexFileResolution, float("inf"))
+
+        # by name rather than load order, so that the same textures are always packed the same way
+        for idx in sorted(range(len(self.REGISTERED_MOD_TEXTURES)), key=lambda idx: self.REGISTERED_MOD_TEXTURES[idx].getName()):
+            rt = self.REGISTERED_MOD_TEXTURES[idx]
+            packer.add_rect(rt.FileSizeX, rt.FileSizeY, idx)
+
+        packer.pack()
+        self.Placements = {rid: (b, x, y, w, h) for b, x, y, w, h, rid in packer.rect_list()}
+
+        missing = [str(rt) for idx, rt in enumerate(self.REGISTERED_MOD_TEXTURES) if idx not in self.Placements]
+        if missing:
+            raise Exception(f"Textures larger than {self._TexFileResolution} x {self._TexFileResolution} cannot be auto-packed. Contact Mod Author: " + ", ".join(missing))
+
+        ui.log.log(f"  Packed {len(self.REGISTERED_MOD_TEXTURES)} textures into {self.getBinCount()} pages ({self.Algorithm}, {self.Sort})")
+
+    def getLayout(self):
+        """The packing as a list of [name, bin, x, y, w, h], see `setLayout`"""
+        return [[rt.getName(), *self.Placements[idx]] for idx, rt in enumerate(self.REGISTERED_MOD_TEXTURES)]
+
+    def setLayout(self, layout):
+        """Reuse a packing returned by `getLayout` for the same textures, instead of packing them again"""
+        placements = {name: placement for name, *placement in layout}
+        self.Placements = {idx: tuple(placements[rt.getName()]) for idx, rt in enumerate(self.REGISTERED_MOD_TEXTURES)}
+
+    def getBinCount(self):
+        return len(set(b for b, x, y, w, h in self.Placements.values()))
+
+    def composite(self, images=None):
+        """Copy the textures into their pages, returns one `Texture` per bin"""
+        pages = [Texture(None, create=True, width=self._TexFileResolution, height=self._TexFileResolution) for _ in range(self.getBinCount())]
+        for idx, (b, x, y, w, h) in self.Placements.items():
+            rt = self.REGISTERED_MOD_TEXTURES[idx]
+            pages[b].pack_png(self.getModTexturePath(rt.ParentMod, rt.TexPath), x, y, w, h, images=images)
+        return pages
+
+    def getXMLTexture(self, mod=None):
+        """The pages and regions of the packed textures, only of `mod` if given"""
+        texRoot = lxml.etree.Element("AllTexturesAndRegions")
+        lxml.etree.SubElement(texRoot, "textures")
+        lxml.etree.SubElement(texRoot, "regions")
+        texTree = lxml.etree.ElementTree(texRoot)
+        regionsNode = texTree.find("//regions")
+        texturesNode = texTree.find("//textures")
+
+        packedRectsSorted = {}
+        for regModTexIDX, (b, x, y, w, h) in self.Placements.items():
+            rt = self.REGISTERED_MOD_TEXTURES[regModTexIDX]
+            if mod is None or rt.ParentMod == mod:
+                packedRectsSorted[rt.CoreRegionID] = (b, str(x), str(y), str(w), str(h), regModTexIDX)
+        # NOT YET SORTED
+        packedRectsSorted = {k: v for k, v in sorted(packedRectsSorted.items())}
+        # NOW SORTED: the IDs have to be added to the textures file in order
+        bins = set()
+
+        for regionID, rect in packedRectsSorted.items():
+            newNode = lxml.etree.SubElement(regionsNode, "re")
+
+            bin, x, y, w, h, regModTexIDX = rect
+            rt: RegisteredTexture
+            rt = self.REGISTERED_MOD_TEXTURES[regModTexIDX]
+            bins.add(bin)
+
+            newNode.set("n", str(regionID))
+            newNode.set("t", str(self.getBinTextureID(bin)))
+            newNode.set("x", x)
+            newNode.set("y", y)
+            newNode.set("w", w)
+            newNode.set("h", h)
+            newNode.set("file", rt.TexPath)
+
+        for bin in sorted(bins):
+            newTex = lxml.etree.SubElement(texturesNode, "t")
+            newTex.set("i", str(self.getBinTextureID(bin)))
+            newTex.set("w", str(self._TexFileResolution))
+            newTex.set("h", str(self._TexFileResolution))
+
+        return texTree
+
+    def getBinTextureID(self, bin: int):
+        return self.FirstTextureID + bin
+
+
+class RegisteredTexture:
+    """All the metadata needed to construct a region node."""
+
+    ParentMod: str
+    TexPath: str
+    CoreRegionID: int
+    FileSizeX: int
+    FileSizeY: int
+
+    def __init__(self, manager: TextureManager, mod: str, texPath: str, regionID: int):
+        self.ParentMod = mod
+        self.TexPath = texPath
+        self.CoreRegionID = regionID
+
+        filepath = manager.getModTexturePath(self.ParentMod, self.TexPath)
+        (w, h) = pngcodec.size(filepath)
+
+        self.FileSizeX = w
+        self.FileSizeY = h
+
+    def getName(self):
+        return f"{self.ParentMod}/{self.TexPath}"
+
+    def __str__(self):
+        return f"[{self.CoreRegionID:0>5}] {self.ParentMod}: {self.TexPath} - ({self.FileSizeX}, {self.FileSizeY})"
+
+
+if __name__ == "__main__":
+    """Pack the textures of the mods given on the command line, and print the pages"""
+    manager = TextureManager()
+    for mod in sys.argv[1:]:
+        for filename in sorted(os.listdir(os.path.join(mod, "textures"))):
+            if filename.endswith(".png"):
+                manager.registerNewTexture(mod, filename, len(manager.REGISTERED_MOD_TEXTURES))
+
+    manager.pack()
+    print(lxml.etree.tostring(manager.getXMLTexture(), pretty_print=True).decode("utf-8"))
+    numBins = manager.getBinCount()
+    numRects = len(manager.Placements)
+    print(f"{numBins} bins, {numRects} rects")
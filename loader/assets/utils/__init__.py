@@ -3,5 +3,5 @@ import os
 from lxml import etree
 
 
-def create_xml_parser() -> etree.XMLParser:
-    return etree.XMLParser(recover=True, encoding=os.environ.get('FORCE_PARSER_ENCODING', None))
+def create_xml_parser(**options) -> etree.XMLParser:
+    return etree.XMLParser(recover=True, encoding=os.environ.get('FORCE_PARSER_ENCODING', None), **options)
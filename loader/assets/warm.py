@@ -0,0 +1,168 @@
+"""Parsed vanilla XML files kept in memory between the builds of a mod loader session
+
+Parsing the core library is a fixed cost of every build. Once a build is done, the trees of its
+game version are parsed again in the background, while the game runs, and the next build of the
+session takes them instead of parsing. They are dropped after MODLOADER_WARM_CACHE_IDLE seconds
+without a build, or as soon as the system runs low on memory.
+"""
+
+import ctypes
+import sys
+import threading
+import time
+
+import ui.log
+
+from loader import settings
+
+# Seconds the trees are kept without a build, override with MODLOADER_WARM_CACHE_IDLE, 0 disables
+DEFAULT_IDLE_SECONDS = 15 * 60
+
+# The trees are dropped, or not parsed at all, when less memory than this is available
+LOW_MEMORY_MB = 1024
+
+# How often the idle timeout and the available memory are checked, in seconds
+CHECK_INTERVAL = 30
+
+
+def idle_timeout():
+    return settings.env_int("MODLOADER_WARM_CACHE_IDLE", DEFAULT_IDLE_SECONDS, minimum=0)
+
+
+def available_memory():
+    """Memory available to new allocations in bytes, None if it can't be measured here
+
+    Read from /proc/meminfo on Linux, GlobalMemoryStatusEx on Windows, psutil elsewhere when installed.
+    """
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    if sys.platform == "win32":
+        return _windows_available_memory()
+
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.virtual_memory().available
+
+
+class _MEMORYSTATUSEX(ctypes.Structure):
+    _fields_ = [
+        ("dwLength", ctypes.c_uint32),
+        ("dwMemoryLoad", ctypes.c_uint32),
+        ("ullTotalPhys", ctypes.c_ulonglong),
+        ("ullAvailPhys", ctypes.c_ulonglong),
+        ("ullTotalPageFile", ctypes.c_ulonglong),
+        ("ullAvailPageFile", ctypes.c_ulonglong),
+        ("ullTotalVirtual", ctypes.c_ulonglong),
+        ("ullAvailVirtual", ctypes.c_ulonglong),
+        ("ullAvailExtendedVirtual", ctypes.c_ulonglong),
+    ]
+
+
+def _windows_available_memory():
+    status = _MEMORYSTATUSEX()
+    status.dwLength = ctypes.sizeof(_MEMORYSTATUSEX)
+    if not ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+        return None
+    return status.ullAvailPhys
+
+
+class WarmTrees:
+    """Parsed trees of a single game version, each handed out to one build only"""
+
+    def __init__(self):
+        self.key = None
+        self._trees = {}
+        self._lastUsed = 0
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._refiller = None
+        self._memoryUnknown = False
+
+    def take(self, key, filename):
+        """The tree of `filename` kept for the game version `key`, None if there is none"""
+
+        with self._lock:
+            if key != self.key:
+                return None
+            self._lastUsed = time.monotonic()
+            return self._trees.pop(filename, None)
+
+    def refill(self, key, parsers):
+        """Run the {filename: parse function} `parsers` in the background and keep their trees for `key`"""
+
+        if idle_timeout() <= 0:
+            return
+        self._refiller = threading.Thread(target=self._refill, args=(key, parsers), daemon=True)
+        self._refiller.start()
+
+    def wait(self):
+        """Wait for the trees being parsed by `refill`, if any"""
+
+        refiller = self._refiller
+        if refiller is not None:
+            refiller.join()
+
+    def release(self, reason):
+        with self._lock:
+            if self._trees:
+                ui.log.log("  Releasing the parsed core library kept in memory ({})".format(reason))
+            self.key = None
+            self._trees = {}
+
+    def _refill(self, key, parsers):
+        trees = {}
+        for filename, parse in parsers.items():
+            if self._low_memory():
+                self.release("low memory")
+                return
+            try:
+                trees[filename] = parse()
+            except Exception as e:
+                ui.log.log("  ERROR: Could not keep {} in memory: {}".format(filename, e))
+                return
+
+        with self._lock:
+            self.key = key
+            self._trees = trees
+            self._lastUsed = time.monotonic()
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, daemon=True)
+                self._watcher.start()
+
+    def _watch(self):
+        """Release the trees once idle for too long or when memory runs low"""
+
+        while True:
+            time.sleep(CHECK_INTERVAL)
+            with self._lock:
+                if not self._trees:
+                    self._watcher = None
+                    return
+                idle = time.monotonic() - self._lastUsed
+
+            if idle > idle_timeout():
+                self.release("idle for {}s".format(int(idle)))
+            elif self._low_memory():
+                self.release("low memory")
+
+    def _low_memory(self):
+        available = available_memory()
+        if available is None:
+            if not self._memoryUnknown:
+                self._memoryUnknown = True
+                ui.log.log("  Cannot measure the available memory here, the parsed core library is only released once idle")
+            return False
+        return available < LOW_MEMORY_MB * 1024 * 1024
+
+
+# shared by every build of the process
+TREES = WarmTrees()
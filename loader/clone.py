@@ -0,0 +1,90 @@
+import contextlib
+import ctypes
+import errno
+import os
+import shutil
+import sys
+
+import ui.log
+
+# ioctl request to share the extents of a file, from linux/fs.h
+FICLONE = 0x40049409
+
+# Files and folders being written by `atomic_write` have this suffix until complete
+PARTIAL_SUFFIX = ".partial"
+
+
+def _reflink(src, dst):
+    """Copy-on-write clone of `src`, only supported by some filesystems (btrfs, xfs, apfs...)"""
+
+    if sys.platform.startswith("linux"):
+        import fcntl
+
+        with open(src, "rb") as source, open(dst, "wb") as target:
+            try:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            except OSError:
+                target.close()
+                os.unlink(dst)
+                raise
+
+    elif sys.platform == "darwin":
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), dst)
+
+    else:
+        raise OSError(errno.ENOTSUP, "reflinks are not supported on this platform", dst)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+@contextlib.contextmanager
+def atomic_write(path):
+    """Give the temporary path to write `path` at, moved into place once the block completes
+
+    `path` is then either untouched or complete, never truncated by an interrupted write.
+    Works for folders too, as long as `path` doesn't exist or is an empty folder by then.
+    """
+
+    partial = path + PARTIAL_SUFFIX
+    _remove(partial)
+    try:
+        yield partial
+    except BaseException:
+        _remove(partial)
+        raise
+    os.replace(partial, path)
+
+
+def clone_file(src, dst):
+    """Make `dst` a copy of `src`, using the cheapest way available
+
+    Tries a copy-on-write clone first, then a hardlink and only copies the data as a last
+    resort. With a hardlink both paths share the same file, so neither must be modified
+    in place afterwards, only replaced. Clones and copies keep the timestamps of `src`, so
+    `dst` looks like the same file to the caches keyed on its mtime.
+    """
+
+    with atomic_write(dst) as partial:
+        try:
+            _reflink(src, partial)
+            method = "reflink"
+        except OSError:
+            try:
+                os.link(src, partial)
+                method = "hardlink"
+            except OSError:
+                shutil.copyfile(src, partial)
+                method = "copy"
+        if method != "hardlink":
+            shutil.copystat(src, partial)
+
+    ui.log.log("  {} {} to {}".format(method.capitalize(), src, dst))
+    return method
@@ -1,9 +1,24 @@
+import glob
+import os
+
 import ui.log
 
 import loader.assets.explode
 import loader.assets.library
 
 
+def _previous_extraction(corePath):
+    """Most recent extraction of another game version next to `corePath`, to reuse textures from"""
+
+    pattern = os.path.join(os.path.dirname(os.path.abspath(corePath)), "spacehaven_*", "library", loader.assets.explode.EXPLODED_DIR, loader.assets.explode.MANIFEST_FILE)
+    manifests = [path for path in glob.glob(pattern) if not path.startswith(os.path.abspath(corePath) + os.sep)]
+    if not manifests:
+        return None
+
+    manifest = max(manifests, key=os.path.getmtime)
+    return os.path.dirname(os.path.dirname(os.path.dirname(manifest)))
+
+
 def extract(jarPath, corePath):
     """Extract and annotate game assets"""
 
@@ -13,4 +28,4 @@ def extract(jarPath, corePath):
     loader.assets.library.extract(jarPath, corePath)
 
     ui.log.updateBackgroundState("Unpacking textures")
-    loader.assets.explode.explode(corePath)
+    loader.assets.explode.explode(corePath, previousPath=_previous_extraction(corePath))
@@ -1,58 +1,99 @@
 import os
-import tempfile
 
 import ui.log
 
+import loader.assets.cache
 import loader.assets.library
 import loader.assets.merge
+import loader.clone
+import loader.overlay
+import loader.quicklaunch
 
 
-def quick_launch_filename(mods_cache_signature):
-    return "quicklaunch_" + mods_cache_signature + ".jar"
-
-
-def load(jarPath, activeMods, mods_cache_signature=None):
+def load(jarPath, activeMods, mods_cache_signature=None, gameVersion=None):
     """Load mods into spacehaven.jar"""
 
     modPaths = [mod.path for mod in activeMods]
 
     unload(jarPath, message=False)
 
-    coreDirectory = tempfile.TemporaryDirectory()
-    corePath = coreDirectory.name
-
     ui.log.log("Loading mods...")
     ui.log.log("  jarPath: {}".format(jarPath))
-    ui.log.log("  corePath: {}".format(corePath))
     ui.log.log("  modPaths:\n  {}".format("\n  ".join(modPaths)))
 
-    loader.assets.library.extract(jarPath, corePath)
-    ui.log.updateBackgroundState("Installing Mods")
-    extra_assets = loader.assets.merge.mods(corePath, activeMods, modPaths)
+    ui.log.updateBackgroundState("Extracting game files")
+    vanillaPath = loader.assets.cache.vanilla_library(jarPath, gameVersion)
+    ui.log.log("  vanillaPath: {}".format(vanillaPath))
 
-    os.rename(jarPath, jarPath + ".vanilla")
-    loader.assets.library.patch(jarPath + ".vanilla", corePath, jarPath, extra_assets=extra_assets)
+    profile = loader.assets.library.output_profile()
 
-    coreDirectory.cleanup()
+    # the build happens in memory, only the patched jar is written to disk
+    ui.log.updateBackgroundState("Installing Mods")
+    with loader.assets.library.VanillaLibrary(jarPath, vanillaPath) as vanilla:
+        modded = loader.assets.merge.mods(vanilla, activeMods, modPaths, profile=profile)
+
+    if _launch_mode(jarPath) == "overlay":
+        builtPath = loader.overlay.overlay_path(jarPath)
+        with loader.clone.atomic_write(builtPath) as partial:
+            loader.assets.library.overlay(partial, modded, profile=profile)
+        loader.overlay.install(jarPath)
+    else:
+        builtPath = jarPath
+        moddedPath = jarPath + ".modded"
+        loader.assets.library.patch(jarPath, moddedPath, modded, profile=profile)
+        _swap_in(jarPath, moddedPath)
 
     if mods_cache_signature:
-        import shutil
-
-        quicklaunchfilename = quick_launch_filename(mods_cache_signature)
         ui.log.updateBackgroundState("Saving QuickLaunch file")
-        ui.log.log("Writing to quickLaunch file: {}".format(quicklaunchfilename))
-        shutil.copyfile(jarPath, quicklaunchfilename)
+        quicklaunchfilename = loader.quicklaunch.store(mods_cache_signature, builtPath)
+        ui.log.log("Wrote quickLaunch file: {}".format(quicklaunchfilename))
 
+    # parsed while the game runs, so that relaunching with other mods doesn't parse them again
+    vanilla.keep_warm(loader.assets.library.PATCHABLE_XML_FILES)
 
-def quickload(jarPath, mods_cache_signature):
-    import shutil
 
+def quickload(jarPath, mods_cache_signature):
     unload(jarPath, message=False)
-    os.rename(jarPath, jarPath + ".vanilla")
-    quicklaunchfilename = quick_launch_filename(mods_cache_signature)
+    quicklaunchfilename = loader.quicklaunch.lookup(mods_cache_signature)
+    if quicklaunchfilename is None:
+        raise FileNotFoundError("No quickLaunch file for signature {}".format(mods_cache_signature))
+
     ui.log.updateBackgroundState("Loading QuickLaunch file")
     ui.log.log("Reusing quickLaunch file: {}".format(quicklaunchfilename))
-    shutil.copyfile(quicklaunchfilename, jarPath)
+    if _launch_mode(jarPath) == "overlay":
+        loader.clone.clone_file(quicklaunchfilename, loader.overlay.overlay_path(jarPath))
+        loader.overlay.install(jarPath)
+    else:
+        moddedPath = jarPath + ".modded"
+        loader.clone.clone_file(quicklaunchfilename, moddedPath)
+        _swap_in(jarPath, moddedPath)
+    loader.quicklaunch.touch(mods_cache_signature)
+
+
+def _launch_mode(jarPath):
+    mode = loader.overlay.launch_mode()
+    if mode == "overlay" and not loader.overlay.available(jarPath):
+        ui.log.log("  ERROR: No {} next to {}, patching spacehaven.jar instead".format(loader.overlay.CONFIG_FILE, jarPath))
+        return "patch"
+    return mode
+
+
+def _swap_in(jarPath, moddedPath):
+    """Replace spacehaven.jar by `moddedPath`, keeping the original as spacehaven.jar.vanilla
+
+    The jars are only ever linked or renamed, never rewritten, so the original keeps its
+    mtime and the vanilla cache stays valid. With a hardlink the game always finds a
+    complete jar, otherwise the original is renamed away just before the modded one
+    takes its place.
+    """
+
+    vanillaPath = jarPath + ".vanilla"
+    try:
+        with loader.clone.atomic_write(vanillaPath) as partial:
+            os.link(jarPath, partial)
+    except OSError:
+        os.replace(jarPath, vanillaPath)
+    os.replace(moddedPath, jarPath)
 
 
 def unload(jarPath, message=True):
@@ -61,6 +102,12 @@ def unload(jarPath, message=True):
     if message:
         ui.log.updateBackgroundState("Unloading mods")
 
+    if os.path.exists(jarPath + ".modded"):
+        os.remove(jarPath + ".modded")
+
+    # whatever the current launch mode, mods may have been loaded with the other one
+    loader.overlay.uninstall(jarPath)
+
     vanillaPath = jarPath + ".vanilla"
     if not os.path.exists(vanillaPath):
         if message:
@@ -69,5 +116,4 @@ def unload(jarPath, message=True):
 
     ui.log.log("  Restoring original {} from {}".format(jarPath, vanillaPath))
     # FIXME check if the game is running again if that fails ? Restarting from ingame after a language change does that
-    os.remove(jarPath)
-    os.rename(vanillaPath, jarPath)
+    os.replace(vanillaPath, jarPath)
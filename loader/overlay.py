@@ -0,0 +1,89 @@
+import json
+import os
+
+import ui.log
+
+import loader.clone
+import loader.settings
+
+# Written next to spacehaven.jar and put first on the classpath, so that its library files
+# shadow the vanilla ones
+OVERLAY_JAR = "spacehaven-modloader-overlay.jar"
+
+CONFIG_FILE = "config.json"
+
+LAUNCH_MODES = ("patch", "overlay")
+
+# Rewriting spacehaven.jar is the safe default, override with MODLOADER_LAUNCH_MODE
+DEFAULT_LAUNCH_MODE = "patch"
+
+
+def launch_mode(name=None):
+    """How mods are applied: "patch" rewrites spacehaven.jar, "overlay" adds a jar in front of it"""
+
+    if name is None:
+        name = loader.settings.env_choice("MODLOADER_LAUNCH_MODE", LAUNCH_MODES, DEFAULT_LAUNCH_MODE)
+
+    if name not in LAUNCH_MODES:
+        ui.log.log("  ERROR: Unknown launch mode {}, expected one of {}".format(name, ", ".join(LAUNCH_MODES)))
+        return DEFAULT_LAUNCH_MODE
+    return name
+
+
+def overlay_path(jarPath):
+    return os.path.join(os.path.dirname(jarPath), OVERLAY_JAR)
+
+
+def config_path(jarPath):
+    return os.path.join(os.path.dirname(jarPath), CONFIG_FILE)
+
+
+def available(jarPath):
+    """The overlay needs the config.json that the game launcher reads its classpath from"""
+
+    return os.path.isfile(config_path(jarPath))
+
+
+def _update_class_path(jarPath, update):
+    path = config_path(jarPath)
+    with open(path, "r", encoding="utf-8") as f:
+        jsonObj = json.load(f)
+
+    classPath = jsonObj["classPath"]
+    if not update(classPath):
+        return
+
+    jsonObj["classPath"] = classPath
+    with loader.clone.atomic_write(path) as partial, open(partial, "w", encoding="utf-8") as f:
+        f.write(json.dumps(jsonObj, indent=4))
+    ui.log.log("  Updated {}".format(path))
+
+
+def install(jarPath):
+    """Put the overlay jar first on the classpath"""
+
+    def add(classPath):
+        if OVERLAY_JAR in classPath:
+            return False
+        classPath.insert(0, OVERLAY_JAR)
+        return True
+
+    _update_class_path(jarPath, add)
+
+
+def uninstall(jarPath):
+    """Remove the overlay jar from the classpath and from the game folder"""
+
+    def remove(classPath):
+        if OVERLAY_JAR not in classPath:
+            return False
+        classPath.remove(OVERLAY_JAR)
+        return True
+
+    if available(jarPath):
+        _update_class_path(jarPath, remove)
+
+    for path in (overlay_path(jarPath), overlay_path(jarPath) + loader.clone.PARTIAL_SUFFIX):
+        if os.path.exists(path):
+            ui.log.log("  Removing {}".format(path))
+            os.remove(path)
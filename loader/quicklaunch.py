@@ -0,0 +1,225 @@
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import time
+
+import ui.log
+import version
+
+import loader.assets.cache
+import loader.clone
+import loader.overlay
+import loader.settings
+
+QUICKLAUNCH_CACHE_PATH = os.path.join(loader.assets.cache.CACHE_ROOT, "quicklaunch")
+
+INDEX_FILE = "index.json"
+
+# Size, mtime and content hash of the files of every mod folder, so that only new or modified files are hashed
+HASHES_FILE = "hashes.json"
+
+# Disk budget for the quicklaunch jars, override with MODLOADER_QUICKLAUNCH_BUDGET_MB
+DEFAULT_BUDGET_MB = 1024
+
+# Files written into the mod folders by the mod loader itself, or that don't change the build
+IGNORED_MOD_FILES = [
+    "info",
+    "info.xml",
+    "disabled.txt",
+    "custom_texture_*.png",
+    "library/generated_textures.xml",
+]
+
+# mod folder => {relative path: [size, mtime, content hash]}, loaded from HASHES_FILE on first use
+_file_hashes = {}
+
+
+def _budget():
+    return loader.settings.env_int("MODLOADER_QUICKLAUNCH_BUDGET_MB", DEFAULT_BUDGET_MB, minimum=0) * 1024 * 1024
+
+
+def _file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _hashes_path():
+    return os.path.join(QUICKLAUNCH_CACHE_PATH, HASHES_FILE)
+
+
+def _mod_hashes(modPath):
+    """Known files of the mod folder `modPath`, as {relative path: [size, mtime, content hash]}"""
+
+    if not _file_hashes:
+        try:
+            with open(_hashes_path(), "r") as f:
+                _file_hashes.update(json.load(f))
+        except (FileNotFoundError, ValueError):
+            pass
+    return _file_hashes.get(os.path.abspath(modPath), {})
+
+
+def _save_mod_hashes(modPath, hashes):
+    _file_hashes[os.path.abspath(modPath)] = hashes
+    os.makedirs(QUICKLAUNCH_CACHE_PATH, exist_ok=True)
+    with loader.clone.atomic_write(_hashes_path()) as partial, open(partial, "w") as f:
+        json.dump(_file_hashes, f)
+
+
+def _is_ignored(relativePath):
+    return any(fnmatch.fnmatch(relativePath, pattern) for pattern in IGNORED_MOD_FILES)
+
+
+def mod_signature(mod):
+    """Hash the contents of a mod folder and its config variable values
+
+    Files are only read when their size or mtime changed since they were last hashed.
+    Hidden files and folders, such as .git, are skipped: the mod loader never reads them.
+    """
+
+    known = _mod_hashes(mod.path)
+    hashes = {}
+    sha = hashlib.sha1()
+    for root, dirs, files in os.walk(mod.path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for filename in sorted(files):
+            if filename.startswith("."):
+                continue
+            path = os.path.join(root, filename)
+            relativePath = os.path.relpath(path, mod.path).replace(os.sep, "/")
+            if _is_ignored(relativePath):
+                continue
+
+            stat = os.stat(path)
+            entry = known.get(relativePath)
+            if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+                entry = [stat.st_size, stat.st_mtime_ns, _file_hash(path)]
+            hashes[relativePath] = entry
+            sha.update("{}\0{}\0".format(relativePath, entry[2]).encode("utf-8"))
+
+    if hashes != known:
+        _save_mod_hashes(mod.path, hashes)
+
+    for var in mod.variables:
+        sha.update("{}={}\0".format(var.name, var.value).encode("utf-8"))
+
+    return sha.hexdigest()
+
+
+def signature(gameVersion, mods):
+    """Cache key of the jar built from `mods`"""
+
+    # overlay and patched jars can't stand in for each other
+    mods_signature = ["spacehaven", gameVersion, "modloader", version.version, loader.overlay.launch_mode()]
+    for mod in mods:
+        mods_signature.append(mod.name)
+        mods_signature.append(mod_signature(mod))
+
+    return hashlib.sha1("__".join(mods_signature).encode("utf-8")).hexdigest()
+
+
+def _index_path():
+    return os.path.join(QUICKLAUNCH_CACHE_PATH, INDEX_FILE)
+
+
+def _load_index():
+    try:
+        with open(_index_path(), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_index(index):
+    os.makedirs(QUICKLAUNCH_CACHE_PATH, exist_ok=True)
+    with loader.clone.atomic_write(_index_path()) as partial, open(partial, "w") as f:
+        json.dump(index, f, indent=4)
+
+
+def lookup(key):
+    """Return the path of the quicklaunch jar for `key`, or None"""
+
+    entry = _load_index().get(key)
+    if entry is None:
+        return None
+
+    path = os.path.join(QUICKLAUNCH_CACHE_PATH, entry["file"])
+    if not os.path.isfile(path):
+        return None
+    return path
+
+
+def touch(key):
+    """Mark the quicklaunch jar for `key` as just used"""
+
+    index = _load_index()
+    if key in index:
+        index[key]["last_used"] = time.time()
+        _save_index(index)
+
+
+def store(key, jarPath):
+    """Keep a copy of `jarPath` as the quicklaunch jar for `key`
+
+    The copy is usually a link to the jar itself, which is fine as jars are only ever replaced.
+    """
+
+    index = _load_index()
+
+    filename = key + ".jar"
+    path = os.path.join(QUICKLAUNCH_CACHE_PATH, filename)
+    os.makedirs(QUICKLAUNCH_CACHE_PATH, exist_ok=True)
+    loader.clone.clone_file(jarPath, path)
+
+    index[key] = {"file": filename, "size": os.path.getsize(path), "last_used": time.time()}
+    _evict(index, _budget(), keep=key)
+    _save_index(index)
+
+    return path
+
+
+def remove(key):
+    """Delete the quicklaunch jar for `key`"""
+
+    index = _load_index()
+    entry = index.pop(key, None)
+    if entry is None:
+        return
+
+    try:
+        os.unlink(os.path.join(QUICKLAUNCH_CACHE_PATH, entry["file"]))
+    except FileNotFoundError:
+        pass
+    _save_index(index)
+
+
+def _evict(index, budget, keep):
+    """Delete the least recently used jars until the cache fits in `budget` bytes"""
+
+    total = sum(entry["size"] for entry in index.values())
+    for key in sorted(index, key=lambda key: index[key]["last_used"]):
+        if total <= budget:
+            break
+        if key == keep:
+            continue
+
+        entry = index.pop(key)
+        total -= entry["size"]
+        ui.log.log("  Evicting quicklaunch file {}".format(entry["file"]))
+        try:
+            os.unlink(os.path.join(QUICKLAUNCH_CACHE_PATH, entry["file"]))
+        except FileNotFoundError:
+            pass
+
+    # jars left behind by an interrupted store, or by older mod loader versions
+    known = set(entry["file"] for entry in index.values())
+    leftovers = glob.glob(os.path.join(QUICKLAUNCH_CACHE_PATH, "*.jar*")) + glob.glob("quicklaunch_*.jar")
+    for path in leftovers:
+        if os.path.basename(path) not in known:
+            ui.log.log("  Removing stale quicklaunch file {}".format(path))
+            os.unlink(path)
@@ -0,0 +1,53 @@
+"""Settings read from MODLOADER_* environment variables, see the Settings section of the README
+
+Empty variables count as unset. Invalid values are reported in the log and replaced by the
+default, they never stop a build.
+"""
+
+import os
+
+import ui.log
+
+
+def env_int(name, default, minimum=None, maximum=None):
+    """Whole number set by the environment variable `name`, `default` if unset or out of range"""
+
+    value = os.environ.get(name)
+    if not value:
+        return default
+
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    if number is None or (minimum is not None and number < minimum) or (maximum is not None and number > maximum):
+        if minimum is not None and maximum is not None:
+            expected = "a number from {} to {}".format(minimum, maximum)
+        elif minimum is not None:
+            expected = "a number of at least {}".format(minimum)
+        else:
+            expected = "a number"
+        ui.log.log("  ERROR: {} must be {}, got {}, using {}".format(name, expected, value, default))
+        return default
+    return number
+
+
+def env_choice(name, choices, default):
+    """One of `choices` set by the environment variable `name`, `default` if unset or unknown"""
+
+    value = os.environ.get(name)
+    if not value:
+        return default
+
+    if value not in choices:
+        ui.log.log("  ERROR: Unknown {} {}, expected one of {}".format(name, value, ", ".join(choices)))
+        return default
+    return value
+
+
+def workers(name, workers=None):
+    """Threads or processes of a stage of the build: `workers`, else set by `name`, else one per core"""
+
+    if workers is None:
+        workers = env_int(name, 0, minimum=0)
+    return workers or os.cpu_count() or 1
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import multiprocessing
 import os
 import platform
 import threading
@@ -13,6 +14,7 @@ from tkinter import filedialog, messagebox, ttk, font, scrolledtext
 
 import loader.extract
 import loader.load
+import loader.quicklaunch
 import ui.database
 from ui.gameinfo import GameInfo
 import ui.header
@@ -574,21 +576,12 @@ class Window(Frame):
         return DatabaseHandler.getActiveMods()
 
     def current_mods_signature(self):
-        import hashlib
-
-        mods_signature = ["spacehaven", self.gameInfo.version]
         # mods are supposedly ordered alphabetically
-        for mod in self.mods_enabled():
-            mods_signature.append(mod.name)
-            mods_signature.append(mod.version or "VERSION_UNKNOWN")
-
-        text_sig = "__".join(mods_signature).lower()
-        md5 = hashlib.md5(text_sig.encode("utf-8")).hexdigest()
-        return md5
+        return loader.quicklaunch.signature(self.gameInfo.version, self.mods_enabled())
 
     def quick_launch_available(self):
         mods_sig = self.current_mods_signature()
-        return os.path.isfile(loader.load.quick_launch_filename(mods_sig))
+        return loader.quicklaunch.lookup(mods_sig) is not None
 
     def check_quick_launch(self):
         if not self.mods_enabled():
@@ -604,7 +597,7 @@ class Window(Frame):
 
     def clear_quick_launch(self):
         try:
-            os.unlink(loader.load.quick_launch_filename(self.current_mods_signature()))
+            loader.quicklaunch.remove(self.current_mods_signature())
         except:
             pass
         self.check_quick_launch()
@@ -659,7 +652,7 @@ class Window(Frame):
                 mod.saveConfig()
 
         try:
-            loader.load.load(self.jarPath, xmlMods, self.current_mods_signature())
+            loader.load.load(self.jarPath, xmlMods, self.current_mods_signature(), self.gameInfo.version)
             ui.launcher.launchAndWait(self.gamePath)
             loader.load.unload(self.jarPath)
         except:
@@ -686,6 +679,9 @@ def handleException(type, value, trace):
 
 
 if __name__ == "__main__":
+    # texture explode runs in worker processes, which frozen builds start through this script
+    multiprocessing.freeze_support()
+
     root = Tk()
     root.geometry("890x669")
     root.report_callback_exception = handleException
@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 import sys
 
@@ -11,7 +12,15 @@ class Logger:
         self.gameLog = None
 
         self.localPath = os.path.join(os.path.dirname(sys.argv[0]), "logs.txt")
-        self.localLog = open(self.localPath, "w")
+
+        # worker processes import this module again, they must add to the log of the main process
+        # rather than truncate it. Everyone appends so that lines are never written over.
+        if multiprocessing.parent_process() is not None:
+            self.localLog = open(self.localPath, "a")
+            return
+
+        open(self.localPath, "w").close()
+        self.localLog = open(self.localPath, "a")
         print("Started logging to {}...".format(self.localPath))
 
         self.logInitialInfo()